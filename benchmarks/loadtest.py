@@ -0,0 +1,198 @@
+#!/usr/bin/env python
+"""
+End-to-end load test of the confirmation flow.
+
+Each simulated user signs up, adds an email address (which sends the
+confirmation over SMTP to a local sink), waits for the message to arrive,
+pulls the activation URL out of it and follows it through the test client.
+The app has no views for signing up or adding an address, so those two
+stages call the ORM and ``add_email`` directly and their timings leave out
+request handling; only the confirm stage goes through a view. Latency is
+reported per stage so the effect of a change can be measured without a real
+mail server:
+
+    python benchmarks/loadtest.py --users=500 --concurrency=8
+"""
+import email
+import os
+import re
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+from optparse import OptionParser
+from os.path import dirname, abspath
+
+sys.path.insert(0, dirname(dirname(abspath(__file__))))
+
+from django.conf import settings
+
+TEMP_DIR = tempfile.mkdtemp()
+
+if not settings.configured:
+    settings.configure(
+        DATABASE_ENGINE='sqlite3',
+        # a file rather than :memory: so worker threads share one database
+        DATABASE_NAME=os.path.join(TEMP_DIR, 'loadtest.db'),
+        DATABASE_OPTIONS={'timeout': 30},
+        SITE_ID=1,
+        ROOT_URLCONF='emailconfirmation.tests.urls',
+        EMAIL_BACKEND='django.core.mail.backends.smtp.EmailBackend',
+        INSTALLED_APPS=[
+            'django.contrib.contenttypes',
+            'django.contrib.auth',
+            'django.contrib.sites',
+            'emailconfirmation',
+            'emailconfirmation.tests',
+        ]
+    )
+
+from django.core.management import call_command
+from django.db import connection
+from django.test.client import Client
+
+from django.contrib.auth.models import User
+
+from emailconfirmation.models import EmailAddress
+from emailconfirmation.tests.smtp import SMTPSink
+
+
+STAGES = ["signup", "add_email", "mail", "confirm"]
+
+ACTIVATE_URL_RE = re.compile(r"https?://[^/\s]+(/\S*confirm/\w+/)")
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[int(round((len(values) - 1) * fraction))]
+
+
+class LoadTest(object):
+    
+    def __init__(self, sink, users, concurrency):
+        self.sink = sink
+        self.users = users
+        self.concurrency = concurrency
+        self.timings = dict((stage, []) for stage in STAGES)
+        self.errors = []
+        self._lock = threading.Lock()
+        self._next = 0
+    
+    def _record(self, stage, started):
+        elapsed = time.time() - started
+        self._lock.acquire()
+        try:
+            self.timings[stage].append(elapsed)
+        finally:
+            self._lock.release()
+        return time.time()
+    
+    def _claim(self):
+        self._lock.acquire()
+        try:
+            if self._next >= self.users:
+                return None
+            self._next += 1
+            return self._next
+        finally:
+            self._lock.release()
+    
+    def flow(self, client, n):
+        username = "user%d" % n
+        address = "%s@example.com" % username
+        
+        started = time.time()
+        user = User.objects.create_user(username, "", "password")
+        started = self._record("signup", started)
+        
+        EmailAddress.objects.add_email(user, address)
+        started = self._record("add_email", started)
+        
+        data = self.sink.wait_for(address)
+        if data is None:
+            raise AssertionError("no confirmation delivered to %s" % address)
+        body = email.message_from_string(data).get_payload(decode=True)
+        match = ACTIVATE_URL_RE.search(body)
+        if match is None:
+            raise AssertionError("no activation URL sent to %s" % address)
+        started = self._record("mail", started)
+        
+        response = client.get(match.group(1))
+        if response.status_code != 200 or "Confirmed" not in response.content:
+            raise AssertionError("confirming %s failed" % address)
+        self._record("confirm", started)
+    
+    def worker(self):
+        client = Client()
+        try:
+            while True:
+                n = self._claim()
+                if n is None:
+                    break
+                try:
+                    self.flow(client, n)
+                except Exception, e:
+                    self._lock.acquire()
+                    try:
+                        self.errors.append(e)
+                    finally:
+                        self._lock.release()
+        finally:
+            connection.close()
+    
+    def run(self):
+        threads = [threading.Thread(target=self.worker)
+                   for i in range(self.concurrency)]
+        started = time.time()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return time.time() - started
+    
+    def report(self, elapsed):
+        completed = len(self.timings["confirm"])
+        print "%d flows in %.2fs with %d threads: %.1f flows/s, %d errors" % (
+            completed, elapsed, self.concurrency, completed / elapsed,
+            len(self.errors))
+        print "%-10s %8s %10s %10s" % ("stage", "count", "p50 ms", "p99 ms")
+        for stage in STAGES:
+            values = self.timings[stage]
+            if not values:
+                continue
+            print "%-10s %8d %10.2f %10.2f" % (
+                stage, len(values),
+                percentile(values, 0.5) * 1000,
+                percentile(values, 0.99) * 1000,
+            )
+        for error in self.errors[:5]:
+            print "error: %s" % error
+
+
+def main():
+    parser = OptionParser()
+    parser.add_option("-n", "--users", type="int", default=200,
+                      help="number of signup flows to run")
+    parser.add_option("-c", "--concurrency", type="int", default=4,
+                      help="number of concurrent clients")
+    options, args = parser.parse_args()
+    
+    sink = SMTPSink()
+    sink.start()
+    settings.EMAIL_HOST = sink.host
+    settings.EMAIL_PORT = sink.port
+    try:
+        call_command("syncdb", interactive=False, verbosity=0)
+        loadtest = LoadTest(sink, options.users, options.concurrency)
+        elapsed = loadtest.run()
+        loadtest.report(elapsed)
+    finally:
+        sink.stop()
+        shutil.rmtree(TEMP_DIR)
+    sys.exit(bool(loadtest.errors))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+"""
+Compares the model-instance lookups on EmailAddressManager with their
+EmailRecord counterparts:
+
+    python benchmarks/lookups.py --users=2000 --calls=5000
+
+For each pair it reports the mean latency per call and how many
+garbage-collector-tracked objects each result keeps alive.
+"""
+import gc
+import random
+import sys
+import time
+
+from optparse import OptionParser
+from os.path import dirname, abspath
+
+sys.path.insert(0, dirname(dirname(abspath(__file__))))
+
+from django.conf import settings
+
+if not settings.configured:
+    settings.configure(
+        DATABASE_ENGINE='sqlite3',
+        DATABASE_NAME=':memory:',
+        SITE_ID=1,
+        INSTALLED_APPS=[
+            'django.contrib.contenttypes',
+            'django.contrib.auth',
+            'django.contrib.sites',
+            'emailconfirmation',
+        ]
+    )
+
+from django.core.management import call_command
+from django.db import transaction
+
+from django.contrib.auth.models import User
+
+from emailconfirmation.models import EmailAddress
+from emailconfirmation.templatetags.emailconfirmation_tags import verified_emails
+
+
+def populate(users):
+    transaction.enter_transaction_management()
+    transaction.managed(True)
+    for n in range(users):
+        user = User.objects.create(username="user%d" % n)
+        for i in range(3):
+            EmailAddress.objects.create(user=user,
+                email="user%d-%d@example.com" % (n, i),
+                verified=True, primary=(i == 0))
+        # a handful of shared addresses so get_users_for has work to do
+        EmailAddress.objects.create(user=user, verified=True,
+            email="shared%d@example.com" % (n % 50))
+    transaction.commit()
+    transaction.leave_transaction_management()
+
+
+def tracked_objects():
+    gc.collect()
+    return len(gc.get_objects())
+
+
+def measure(func, args):
+    started = time.time()
+    for arg in args:
+        func(arg)
+    latency = (time.time() - started) / len(args)
+    # objects kept alive per result, the way a cache or a batch would
+    sample = args[:500]
+    before = tracked_objects()
+    results = [func(arg) for arg in sample]
+    retained = float(tracked_objects() - before) / len(sample)
+    del results
+    return latency, retained
+
+
+def main():
+    parser = OptionParser()
+    parser.add_option("--users", type="int", default=1000)
+    parser.add_option("--calls", type="int", default=5000)
+    options, args = parser.parse_args()
+    
+    call_command("syncdb", interactive=False, verbosity=0)
+    populate(options.users)
+    
+    users = list(User.objects.all())
+    user_sample = [random.choice(users) for i in range(options.calls)]
+    email_sample = ["shared%d@example.com" % random.randrange(50)
+                    for i in range(options.calls)]
+    
+    manager = EmailAddress.objects
+    comparisons = [
+        ("primary email", user_sample,
+            manager.get_primary,
+            lambda user: manager.get_primary_record(user.pk)),
+        ("verified emails", user_sample,
+            lambda user: list(verified_emails(user)),
+            lambda user: manager.get_verified_records(user.pk)),
+        ("users for email", email_sample,
+            manager.get_users_for,
+            manager.get_user_ids_for),
+    ]
+    
+    print "%-16s %-8s %12s %18s" % ("lookup", "api", "us/call", "gc objects/result")
+    for name, sample, model_lookup, record_lookup in comparisons:
+        for api, func in [("models", model_lookup), ("records", record_lookup)]:
+            latency, retained = measure(func, sample)
+            print "%-16s %-8s %12.1f %18.1f" % (name, api, latency * 1e6,
+                                                  retained)
+
+
+if __name__ == '__main__':
+    main()
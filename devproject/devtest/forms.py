@@ -2,6 +2,7 @@ from django import newforms as forms
 from django.core.validators import alnum_re
 
 from django.contrib.auth.models import User
+from emailconfirmation import app_settings
 from emailconfirmation.models import EmailAddress
 
 # this code based in-part on django-registration
@@ -49,6 +50,9 @@ class AddEmailForm(forms.Form):
     email = forms.EmailField(label="Email", required=True, widget=forms.TextInput())
     
     def clean_email(self):
+        if app_settings.EMAIL_CONFIRMATION_UNIQUE_VERIFIED:
+            if not EmailAddress.objects.is_email_available(self.cleaned_data["email"]):
+                raise forms.ValidationError(u"This email address is already in use.")
         try:
             EmailAddress.objects.get(user=self.user, email=self.cleaned_data["email"])
         except EmailAddress.DoesNotExist:
@@ -1,7 +1,21 @@
 from django.contrib import admin
 
-from emailconfirmation.models import EmailAddress, EmailConfirmation
+from emailconfirmation.models import EmailAddress, EmailConfirmation, ConfirmationCount
+
+
+class EmailConfirmationAdmin(admin.ModelAdmin):
+    list_display = ("email_address", "site", "sent", "expires_at", "key_expired")
+    list_filter = ("site",)
+    date_hierarchy = "expires_at"
+    raw_id_fields = ("email_address",)
+
+
+class ConfirmationCountAdmin(admin.ModelAdmin):
+    list_display = ("day", "site", "sent", "confirmed", "expired")
+    list_filter = ("site",)
+    date_hierarchy = "day"
 
 
 admin.site.register(EmailAddress)
-admin.site.register(EmailConfirmation)
\ No newline at end of file
+admin.site.register(EmailConfirmation, EmailConfirmationAdmin)
+admin.site.register(ConfirmationCount, ConfirmationCountAdmin)
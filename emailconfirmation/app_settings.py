@@ -1,3 +1,52 @@
 from django.conf import settings
 
 EMAIL_CONFIRMATION_DAYS = getattr(settings, 'EMAIL_CONFIRMATION_DAYS', 14)
+
+# keep live confirmation keys in Django's cache so confirm_email can skip the
+# key lookup against the database
+EMAIL_CONFIRMATION_CACHE = getattr(settings, 'EMAIL_CONFIRMATION_CACHE', False)
+EMAIL_CONFIRMATION_CACHE_PREFIX = getattr(settings,
+    'EMAIL_CONFIRMATION_CACHE_PREFIX', 'emailconfirmation')
+
+# used by emailconfirmation.routers.ReplicaRouter
+EMAIL_CONFIRMATION_PRIMARY_DATABASE = getattr(settings,
+    'EMAIL_CONFIRMATION_PRIMARY_DATABASE', 'default')
+EMAIL_CONFIRMATION_READ_DATABASES = getattr(settings,
+    'EMAIL_CONFIRMATION_READ_DATABASES', ())
+EMAIL_CONFIRMATION_ROUTED_APPS = getattr(settings,
+    'EMAIL_CONFIRMATION_ROUTED_APPS', ('emailconfirmation',))
+# seconds a user keeps reading from the primary after writing
+EMAIL_CONFIRMATION_PIN_SECONDS = getattr(settings,
+    'EMAIL_CONFIRMATION_PIN_SECONDS', 10)
+
+# pool of reusable mail connections used to deliver confirmations
+EMAIL_CONFIRMATION_POOL_SIZE = getattr(settings,
+    'EMAIL_CONFIRMATION_POOL_SIZE', 4)
+EMAIL_CONFIRMATION_POOL_MAX_MESSAGES = getattr(settings,
+    'EMAIL_CONFIRMATION_POOL_MAX_MESSAGES', 100)
+EMAIL_CONFIRMATION_POOL_IDLE_TIMEOUT = getattr(settings,
+    'EMAIL_CONFIRMATION_POOL_IDLE_TIMEOUT', 30)
+
+# hold email_confirmed/email_confirmation_sent back until the surrounding
+# emailconfirmation.deferred block (or DeferredMiddleware request) has
+# committed
+EMAIL_CONFIRMATION_DEFER_SIGNALS = getattr(settings,
+    'EMAIL_CONFIRMATION_DEFER_SIGNALS', False)
+EMAIL_CONFIRMATION_SIGNAL_BATCH_SIZE = getattr(settings,
+    'EMAIL_CONFIRMATION_SIGNAL_BATCH_SIZE', 100)
+
+# "sync" sends confirmations in the request; "thread" hands them to an
+# in-process pool of EMAIL_CONFIRMATION_DELIVERY_THREADS workers once the
+# surrounding emailconfirmation.deferred block has committed
+EMAIL_CONFIRMATION_DELIVERY = getattr(settings,
+    'EMAIL_CONFIRMATION_DELIVERY', 'sync')
+EMAIL_CONFIRMATION_DELIVERY_THREADS = getattr(settings,
+    'EMAIL_CONFIRMATION_DELIVERY_THREADS', 2)
+# messages waiting beyond this are sent synchronously instead
+EMAIL_CONFIRMATION_DELIVERY_QUEUE_SIZE = getattr(settings,
+    'EMAIL_CONFIRMATION_DELIVERY_QUEUE_SIZE', 100)
+
+# a verified email can belong to only one user, enforced by a partial unique
+# index (PostgreSQL and SQLite); see emailconfirmation.indexes
+EMAIL_CONFIRMATION_UNIQUE_VERIFIED = getattr(settings,
+    'EMAIL_CONFIRMATION_UNIQUE_VERIFIED', False)
@@ -0,0 +1,127 @@
+"""
+Work held back until the surrounding transaction has committed.
+
+Code wrapped with ``deferred`` (or requests passing through
+``emailconfirmation.middleware.DeferredMiddleware``) collects callbacks
+registered with ``call_after_commit`` and, when
+``EMAIL_CONFIRMATION_DEFER_SIGNALS`` is on, the ``email_confirmed`` and
+``email_confirmation_sent`` signals. They run once the outermost block
+returns and are dropped if it raises, so receivers never see a confirmation
+that was rolled back. Combine it with Django's transaction handling with
+``deferred`` on the outside::
+
+    @deferred
+    @transaction.commit_on_success
+    def signup(request):
+        ...
+
+Every event is also delivered through the matching ``*_batch`` signal in
+lists of up to ``EMAIL_CONFIRMATION_SIGNAL_BATCH_SIZE``, so a receiver can
+handle a whole block's worth of events in one call.
+"""
+import threading
+
+from django.utils.functional import wraps
+
+from emailconfirmation import app_settings, signals
+
+
+BATCH_SIGNALS = {
+    signals.email_confirmed: (
+        signals.email_confirmed_batch, "email_address", "email_addresses"),
+    signals.email_confirmation_sent: (
+        signals.email_confirmation_sent_batch, "confirmation", "confirmations"),
+}
+
+_local = threading.local()
+
+
+def is_deferring():
+    return getattr(_local, "pending", None) is not None
+
+
+def enter():
+    if not is_deferring():
+        _local.pending = []
+        _local.depth = 0
+    _local.depth += 1
+
+
+def discard():
+    """
+    Drops any open block along with everything collected in it.
+    """
+    _local.pending = None
+    _local.depth = 0
+
+
+def leave(commit=True):
+    """
+    Closes a block opened with ``enter``. Leaving the outermost block runs
+    everything collected, or drops it if ``commit`` is false.
+    """
+    _local.depth -= 1
+    if _local.depth:
+        return
+    pending, _local.pending = _local.pending, None
+    if commit:
+        _run(pending)
+
+
+def call_after_commit(func, *args, **kwargs):
+    if is_deferring():
+        _local.pending.append((func, args, kwargs))
+    else:
+        func(*args, **kwargs)
+
+
+def send_signal(signal, sender, **kwargs):
+    """
+    Sends ``signal`` now, or once the current block commits if
+    ``EMAIL_CONFIRMATION_DEFER_SIGNALS`` is on.
+    """
+    if app_settings.EMAIL_CONFIRMATION_DEFER_SIGNALS and is_deferring():
+        _local.pending.append((None, (signal, sender), kwargs))
+    else:
+        _run([(None, (signal, sender), kwargs)])
+
+
+def _run(pending):
+    batches = []
+    for func, args, kwargs in pending:
+        if func is not None:
+            func(*args, **kwargs)
+            continue
+        signal, sender = args
+        signal.send(sender=sender, **kwargs)
+        if signal not in BATCH_SIGNALS:
+            continue
+        batch_signal, arg, batch_arg = BATCH_SIGNALS[signal]
+        for batch in batches:
+            if batch[0] is batch_signal and batch[1] is sender:
+                batch[3].append(kwargs[arg])
+                break
+        else:
+            batches.append((batch_signal, sender, batch_arg, [kwargs[arg]]))
+    size = app_settings.EMAIL_CONFIRMATION_SIGNAL_BATCH_SIZE
+    for batch_signal, sender, batch_arg, items in batches:
+        for start in range(0, len(items), size):
+            batch_signal.send(sender=sender,
+                              **{batch_arg: items[start:start + size]})
+
+
+def deferred(func):
+    """
+    Decorator running ``func`` in a block whose deferred work happens after it
+    returns.
+    """
+    def inner(*args, **kwargs):
+        enter()
+        try:
+            result = func(*args, **kwargs)
+        except:
+            leave(commit=False)
+            raise
+        leave()
+        return result
+    return wraps(func)(inner)
@@ -0,0 +1,312 @@
+"""
+Delivery of confirmation messages over pooled mail connections.
+
+``send_mail`` normally opens and closes a backend connection per message,
+which for SMTP means a TCP (and often TLS) handshake per confirmation. The
+``ConnectionPool`` here keeps up to ``EMAIL_CONFIRMATION_POOL_SIZE`` backend
+connections open and hands them out to one sender at a time. A connection is
+replaced once it has sent ``EMAIL_CONFIRMATION_POOL_MAX_MESSAGES`` messages,
+has sat idle for more than ``EMAIL_CONFIRMATION_POOL_IDLE_TIMEOUT`` seconds,
+fails a health check or raises while sending.
+
+With ``EMAIL_CONFIRMATION_DELIVERY = "thread"`` messages are instead handed
+to a ``ThreadedDelivery``: a bounded queue drained by a few worker threads
+sending over the pool. Hand-off waits for the surrounding
+``emailconfirmation.deferred`` block to commit, a full queue falls back to
+sending in the caller's thread, and queued messages are drained when the
+process exits. Tests can call ``flush()`` to wait for delivery. Code that
+paces its own sending can ``set_synchronous(True)`` to send in its own thread
+whatever the setting.
+"""
+import atexit
+import logging
+import Queue
+import threading
+import time
+
+from django.conf import settings
+from django.core.mail import EmailMessage, get_connection
+
+from emailconfirmation import app_settings, deferred
+
+
+logger = logging.getLogger("emailconfirmation.delivery")
+
+
+class PooledConnection(object):
+    
+    def __init__(self, connection):
+        self.connection = connection
+        self.sent = 0
+        self.last_used = time.time()
+    
+    def is_healthy(self):
+        # backends without a live socket (locmem, console, ...) have nothing
+        # to check
+        smtp = getattr(self.connection, "connection", None)
+        if smtp is None:
+            return True
+        try:
+            return smtp.noop()[0] == 250
+        except Exception:
+            return False
+    
+    def close(self):
+        try:
+            self.connection.close()
+        except Exception:
+            pass
+
+
+class ConnectionPool(object):
+    """
+    A bounded, thread-safe pool of mail backend connections.
+
+    Any extra keyword arguments are passed to ``get_connection`` along with
+    ``backend``, so a pool can point at a different server than the one in
+    settings.
+    """
+    
+    def __init__(self, size=None, max_messages=None, idle_timeout=None,
+                 backend=None, **kwargs):
+        if size is None:
+            size = app_settings.EMAIL_CONFIRMATION_POOL_SIZE
+        if max_messages is None:
+            max_messages = app_settings.EMAIL_CONFIRMATION_POOL_MAX_MESSAGES
+        if idle_timeout is None:
+            idle_timeout = app_settings.EMAIL_CONFIRMATION_POOL_IDLE_TIMEOUT
+        self.size = size
+        self.max_messages = max_messages
+        self.idle_timeout = idle_timeout
+        self.backend = backend
+        self.backend_kwargs = kwargs
+        self._idle = []
+        self._open = 0
+        self._condition = threading.Condition()
+    
+    def _connect(self):
+        connection = get_connection(self.backend, **self.backend_kwargs)
+        connection.open()
+        return PooledConnection(connection)
+    
+    def _usable(self, pooled):
+        if pooled.sent >= self.max_messages:
+            return False
+        if time.time() - pooled.last_used > self.idle_timeout:
+            return False
+        return pooled.is_healthy()
+    
+    def acquire(self):
+        """
+        Returns an open ``PooledConnection``, waiting for one to be released
+        if the pool is exhausted.
+        """
+        self._condition.acquire()
+        try:
+            while not self._idle and self._open >= self.size:
+                self._condition.wait()
+            if self._idle:
+                pooled = self._idle.pop()
+            else:
+                pooled = None
+            self._open += 1
+        finally:
+            self._condition.release()
+        try:
+            if pooled is not None and not self._usable(pooled):
+                pooled.close()
+                pooled = None
+            if pooled is None:
+                pooled = self._connect()
+        except:
+            self._discard()
+            raise
+        return pooled
+    
+    def release(self, pooled, broken=False):
+        """
+        Returns a connection to the pool, or closes it if it is ``broken`` or
+        has reached its message limit.
+        """
+        if broken or pooled.sent >= self.max_messages:
+            pooled.close()
+            self._discard()
+            return
+        pooled.last_used = time.time()
+        self._condition.acquire()
+        try:
+            self._open -= 1
+            self._idle.append(pooled)
+            self._condition.notify()
+        finally:
+            self._condition.release()
+    
+    def _discard(self):
+        self._condition.acquire()
+        try:
+            self._open -= 1
+            self._condition.notify()
+        finally:
+            self._condition.release()
+    
+    def send_messages(self, messages):
+        pooled = self.acquire()
+        try:
+            sent = pooled.connection.send_messages(messages)
+        except:
+            self.release(pooled, broken=True)
+            raise
+        pooled.sent += len(messages)
+        self.release(pooled)
+        return sent
+    
+    def close(self):
+        """
+        Closes every idle connection. Connections currently checked out are
+        returned to the pool as usual.
+        """
+        self._condition.acquire()
+        try:
+            idle, self._idle = self._idle, []
+        finally:
+            self._condition.release()
+        for pooled in idle:
+            pooled.close()
+
+
+class ThreadedDelivery(object):
+    """
+    Sends messages from a bounded queue on background threads.
+    """
+    
+    def __init__(self, workers=None, queue_size=None, pool=None):
+        if workers is None:
+            workers = app_settings.EMAIL_CONFIRMATION_DELIVERY_THREADS
+        if queue_size is None:
+            queue_size = app_settings.EMAIL_CONFIRMATION_DELIVERY_QUEUE_SIZE
+        self.workers = workers
+        self.queue = Queue.Queue(queue_size)
+        self.pool = pool
+        self._threads = []
+        self._lock = threading.Lock()
+    
+    def _send(self, messages):
+        (self.pool or get_pool()).send_messages(messages)
+    
+    def start(self):
+        self._lock.acquire()
+        try:
+            while len(self._threads) < self.workers:
+                thread = threading.Thread(target=self._work)
+                thread.setDaemon(True)
+                thread.start()
+                self._threads.append(thread)
+        finally:
+            self._lock.release()
+    
+    def _work(self):
+        while True:
+            messages = self.queue.get()
+            try:
+                if messages is None:
+                    return
+                try:
+                    self._send(messages)
+                except Exception:
+                    logger.exception("sending %d message(s) failed",
+                                     len(messages))
+            finally:
+                self.queue.task_done()
+    
+    def submit(self, messages):
+        """
+        Queues ``messages``, or sends them right away if the queue is full.
+        """
+        self.start()
+        try:
+            self.queue.put_nowait(messages)
+        except Queue.Full:
+            self._send(messages)
+    
+    def flush(self):
+        """
+        Blocks until every queued message has been dealt with.
+        """
+        self.queue.join()
+    
+    def shutdown(self):
+        """
+        Sends whatever is still queued and stops the workers.
+        """
+        self._lock.acquire()
+        try:
+            threads, self._threads = self._threads, []
+        finally:
+            self._lock.release()
+        for thread in threads:
+            self.queue.put(None)
+        for thread in threads:
+            thread.join()
+
+
+_pool = None
+_threaded = None
+_lock = threading.Lock()
+_local = threading.local()
+
+
+def get_pool():
+    global _pool
+    if _pool is None:
+        _lock.acquire()
+        try:
+            if _pool is None:
+                _pool = ConnectionPool()
+        finally:
+            _lock.release()
+    return _pool
+
+
+def get_threaded():
+    global _threaded
+    if _threaded is None:
+        _lock.acquire()
+        try:
+            if _threaded is None:
+                _threaded = ThreadedDelivery()
+                atexit.register(_threaded.shutdown)
+        finally:
+            _lock.release()
+    return _threaded
+
+
+def flush():
+    if _threaded is not None:
+        _threaded.flush()
+
+
+def set_synchronous(synchronous):
+    """
+    Makes ``send_messages`` on the current thread send right away over the
+    pool, even with ``EMAIL_CONFIRMATION_DELIVERY = "thread"``.
+    """
+    _local.synchronous = synchronous
+
+
+def send_messages(messages):
+    if app_settings.EMAIL_CONFIRMATION_DELIVERY == "thread" and \
+            not getattr(_local, "synchronous", False):
+        deferred.call_after_commit(get_threaded().submit, messages)
+        return len(messages)
+    return get_pool().send_messages(messages)
+
+
+def send_mail(subject, message, from_email, recipient_list):
+    """
+    Like ``django.core.mail.send_mail`` but over a pooled connection.
+    """
+    if from_email is None:
+        from_email = settings.DEFAULT_FROM_EMAIL
+    return send_messages([
+        EmailMessage(subject, message, from_email, recipient_list)
+    ])
@@ -0,0 +1,135 @@
+"""
+Indexes that cannot be declared on the models.
+
+They are created by the South migrations and, for sites using plain
+``syncdb``, by a ``post_syncdb`` handler, so every function here is safe to
+run more than once.
+"""
+from django.core.exceptions import ImproperlyConfigured
+from django.db import connections, DatabaseError, DEFAULT_DB_ALIAS
+
+from emailconfirmation import app_settings
+
+
+EMAIL_ADDRESS_TABLE = "emailconfirmation_emailaddress"
+
+UNIQUE_VERIFIED_INDEX = "emailconfirmation_emailaddress_verified_email"
+
+# multi-column indexes on EMAIL_ADDRESS_TABLE serving the manager lookups
+# without touching the table, as (name, columns); a column may be given as
+# (column, direction)
+COVERING_INDEXES = (
+    # get_primary, get_primary_record
+    ("emailconfirmation_emailaddress_user_primary",
+        ("user_id", "primary", "email", "verified")),
+    # get_users_for, get_user_ids_for, is_email_available
+    ("emailconfirmation_emailaddress_email_verified",
+        ("email", "verified", "user_id")),
+    # verified_emails, get_verified_records; the index order is the ordering
+    # they ask for, so no sort is needed
+    ("emailconfirmation_emailaddress_user_verified",
+        ("user_id", "verified", ("primary", "DESC"), "email")),
+)
+
+
+def _engine(using):
+    return connections[using].settings_dict["ENGINE"].split(".")[-1]
+
+
+def supports_partial_indexes(using=DEFAULT_DB_ALIAS):
+    engine = _engine(using)
+    return engine == "sqlite3" or engine.startswith("postgresql")
+
+
+def _create_index(using, sql):
+    """
+    Runs ``sql``, a ``CREATE [UNIQUE] INDEX`` statement, unless the index
+    already exists.
+    """
+    cursor = connections[using].cursor()
+    # PostgreSQL and SQLite can skip an existing index themselves; elsewhere
+    # (MySQL) DDL is not transactional, so the duplicate error can be ignored
+    if supports_partial_indexes(using):
+        cursor.execute(sql.replace(" INDEX ", " INDEX IF NOT EXISTS ", 1))
+    else:
+        try:
+            cursor.execute(sql)
+        except DatabaseError:
+            pass
+
+
+def verified_predicate(using=DEFAULT_DB_ALIAS):
+    """
+    The SQL condition the partial index is built on. Queries must repeat it
+    literally (not as a parameter) for the planner to pick the index.
+    """
+    qn = connections[using].ops.quote_name
+    column = "%s.%s" % (qn(EMAIL_ADDRESS_TABLE), qn("verified"))
+    if _engine(using).startswith("postgresql"):
+        return column
+    return "%s = 1" % column
+
+
+def create_unique_verified_index(using=DEFAULT_DB_ALIAS):
+    """
+    Makes a verified email unique across all users. Fails if the table
+    already holds the same verified email for several users.
+    """
+    if not supports_partial_indexes(using):
+        raise ImproperlyConfigured(
+            "EMAIL_CONFIRMATION_UNIQUE_VERIFIED needs partial index support "
+            "(PostgreSQL or SQLite)")
+    connection = connections[using]
+    qn = connection.ops.quote_name
+    # partial indexes cannot refer to the table by name in their predicate
+    predicate = verified_predicate(using).replace(
+        "%s." % qn(EMAIL_ADDRESS_TABLE), "")
+    _create_index(using, "CREATE UNIQUE INDEX %s ON %s (%s) WHERE %s" % (
+        qn(UNIQUE_VERIFIED_INDEX),
+        qn(EMAIL_ADDRESS_TABLE),
+        qn("email"),
+        predicate,
+    ))
+
+
+def drop_unique_verified_index(using=DEFAULT_DB_ALIAS):
+    qn = connections[using].ops.quote_name
+    cursor = connections[using].cursor()
+    cursor.execute("DROP INDEX IF EXISTS %s" % qn(UNIQUE_VERIFIED_INDEX))
+
+
+def create_covering_indexes(using=DEFAULT_DB_ALIAS):
+    qn = connections[using].ops.quote_name
+    for name, columns in COVERING_INDEXES:
+        sql_columns = []
+        for column in columns:
+            if isinstance(column, tuple):
+                sql_columns.append("%s %s" % (qn(column[0]), column[1]))
+            else:
+                sql_columns.append(qn(column))
+        _create_index(using, "CREATE INDEX %s ON %s (%s)" % (
+            qn(name), qn(EMAIL_ADDRESS_TABLE), ", ".join(sql_columns)))
+
+
+def drop_covering_indexes(using=DEFAULT_DB_ALIAS):
+    connection = connections[using]
+    qn = connection.ops.quote_name
+    cursor = connection.cursor()
+    for name, columns in COVERING_INDEXES:
+        if _engine(using) == "mysql":
+            try:
+                cursor.execute("DROP INDEX %s ON %s" % (
+                    qn(name), qn(EMAIL_ADDRESS_TABLE)))
+            except DatabaseError:
+                pass
+        else:
+            cursor.execute("DROP INDEX IF EXISTS %s" % qn(name))
+
+
+def create_indexes(using=DEFAULT_DB_ALIAS):
+    # syncdb leaves the tables to South when it is installed
+    if EMAIL_ADDRESS_TABLE not in connections[using].introspection.table_names():
+        return
+    create_covering_indexes(using)
+    if app_settings.EMAIL_CONFIRMATION_UNIQUE_VERIFIED:
+        create_unique_verified_index(using)
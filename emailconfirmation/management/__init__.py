@@ -0,0 +1,27 @@
+from django.conf import settings
+from django.db import connections, DEFAULT_DB_ALIAS
+from django.db.models import signals
+
+from emailconfirmation import indexes, models
+
+
+def _migrated(db):
+    """
+    Whether South has run any of this app's migrations on ``db``; they then
+    own its indexes.
+    """
+    if "south" not in settings.INSTALLED_APPS:
+        return False
+    from south.models import MigrationHistory
+    if MigrationHistory._meta.db_table not in \
+            connections[db].introspection.table_names():
+        return False
+    return MigrationHistory.objects.using(db).filter(
+        app_name="emailconfirmation").exists()
+
+
+def create_indexes(sender, db=DEFAULT_DB_ALIAS, **kwargs):
+    # South sends post_syncdb after migrating too
+    if not _migrated(db):
+        indexes.create_indexes(db)
+signals.post_syncdb.connect(create_indexes, sender=models)
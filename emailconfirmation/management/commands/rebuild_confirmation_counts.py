@@ -0,0 +1,34 @@
+import datetime
+import time
+
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction, DEFAULT_DB_ALIAS
+
+from emailconfirmation.models import ConfirmationCount
+
+
+class Command(BaseCommand):
+    help = "Recomputes the daily confirmation counters from the raw tables."
+    option_list = BaseCommand.option_list + (
+        make_option("--since", dest="since",
+            help="First day to rebuild (YYYY-MM-DD). Defaults to the day of "
+                 "the oldest confirmation left."),
+        make_option("--database", dest="database", default=DEFAULT_DB_ALIAS,
+            help="Database to rebuild. Defaults to the \"default\" database."),
+    )
+    
+    def handle(self, **options):
+        since = options.get("since")
+        if since:
+            try:
+                since = datetime.date(*time.strptime(since, "%Y-%m-%d")[:3])
+            except ValueError:
+                raise CommandError("--since must be a date like 2010-01-31")
+        using = options.get("database")
+        rebuild = transaction.commit_on_success(using=using)(
+            ConfirmationCount.objects.rebuild)
+        days = rebuild(since=since, using=using)
+        if int(options.get("verbosity", 1)) > 0:
+            print "Rebuilt confirmation counts for %d site-day(s)." % days
@@ -0,0 +1,115 @@
+import datetime
+import os
+import sys
+import time
+
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DEFAULT_DB_ALIAS
+
+from emailconfirmation import deferred, delivery
+from emailconfirmation.models import EmailAddress, EmailConfirmation
+
+
+class Command(BaseCommand):
+    help = ("Sends a new confirmation to every unverified email address that "
+            "has no live confirmation key.")
+    option_list = BaseCommand.option_list + (
+        make_option("--batch-size", dest="batch_size", type="int",
+            default=100, help="Addresses to load per query."),
+        make_option("--rate", dest="rate", type="float", default=10,
+            help="Messages to send per second."),
+        make_option("--checkpoint", dest="checkpoint",
+            help="File recording progress; an interrupted run picks up from "
+                 "it when given the same file."),
+        make_option("--database", dest="database", default=DEFAULT_DB_ALIAS,
+            help="Database to use. Defaults to the \"default\" database."),
+    )
+    
+    def handle(self, **options):
+        batch_size = options.get("batch_size")
+        rate = options.get("rate")
+        if batch_size < 1 or rate <= 0:
+            raise CommandError("--batch-size and --rate must be positive")
+        self.interval = 1.0 / rate
+        self.verbosity = int(options.get("verbosity", 1))
+        checkpoint = options.get("checkpoint")
+        using = options.get("database")
+        
+        last_pk = self.read_checkpoint(checkpoint)
+        targets = EmailAddress.objects.using(using).filter(verified=False)\
+            .exclude(emailconfirmation__expires_at__gt=datetime.datetime.now())
+        total = targets.filter(pk__gt=last_pk).count()
+        self.log("%d address(es) to send to" % total)
+        
+        sent = 0
+        started = time.time()
+        self.next_send = started
+        send_batch = deferred.deferred(self.send_batch)
+        # the throttle paces the sends themselves, so they must not be handed
+        # to delivery threads that would send a whole batch at once
+        delivery.set_synchronous(True)
+        try:
+            while True:
+                # keyset pagination: constant cost per batch however far in
+                # we are
+                batch = list(targets.filter(pk__gt=last_pk).order_by("pk")
+                             .select_related("user")[:batch_size])
+                if not batch:
+                    break
+                send_batch(batch, using)
+                last_pk = batch[-1].pk
+                self.write_checkpoint(checkpoint, last_pk)
+                sent += len(batch)
+                elapsed = time.time() - started
+                remaining = (total - sent) * elapsed / sent
+                self.log("sent %d/%d (%.1f/s), ETA %s" % (
+                    sent, total, sent / max(elapsed, 0.001),
+                    datetime.timedelta(seconds=int(max(remaining, 0))),
+                ))
+        finally:
+            delivery.set_synchronous(False)
+        if checkpoint and os.path.exists(checkpoint):
+            os.remove(checkpoint)
+        self.log("done, sent %d confirmation(s)" % sent)
+    
+    def send_batch(self, batch, using):
+        for email_address in batch:
+            self.throttle()
+            EmailConfirmation.objects.send_confirmation(email_address,
+                                                        using=using)
+    
+    def throttle(self):
+        now = time.time()
+        if self.next_send > now:
+            time.sleep(self.next_send - now)
+        else:
+            # don't make up for time lost to slow sends with a burst
+            self.next_send = now
+        self.next_send += self.interval
+    
+    def read_checkpoint(self, checkpoint):
+        if not checkpoint or not os.path.exists(checkpoint):
+            return 0
+        try:
+            return int(open(checkpoint).read().strip())
+        except ValueError:
+            raise CommandError("checkpoint %s is not readable" % checkpoint)
+    
+    def write_checkpoint(self, checkpoint, last_pk):
+        if not checkpoint:
+            return
+        # write then rename so an interruption never leaves half a file
+        temp = "%s.tmp" % checkpoint
+        f = open(temp, "w")
+        try:
+            f.write("%d\n" % last_pk)
+        finally:
+            f.close()
+        os.rename(temp, checkpoint)
+    
+    def log(self, message):
+        if self.verbosity > 0:
+            sys.stdout.write("%s\n" % message)
+            sys.stdout.flush()
@@ -0,0 +1,44 @@
+from emailconfirmation import deferred
+from emailconfirmation.routers import set_current_user
+
+
+class ReplicaPinningMiddleware(object):
+    """
+    Lets ``ReplicaRouter`` keep a user on the primary right after they have
+    written. Must come after ``AuthenticationMiddleware``.
+    """
+    
+    def process_request(self, request):
+        user = getattr(request, "user", None)
+        if user is not None and user.is_authenticated():
+            set_current_user(user.pk)
+        else:
+            set_current_user(None)
+    
+    def process_response(self, request, response):
+        set_current_user(None)
+        return response
+
+
+class DeferredMiddleware(object):
+    """
+    Runs each request in an ``emailconfirmation.deferred`` block. List it
+    before ``TransactionMiddleware`` so the deferred work runs after the
+    request's transaction has committed.
+    """
+    
+    def process_request(self, request):
+        # Django stops running response middleware once one raises, e.g. when
+        # TransactionMiddleware fails to commit, so an earlier request on this
+        # thread may have left its block open; its work was rolled back
+        deferred.discard()
+        deferred.enter()
+    
+    def process_exception(self, request, exception):
+        if deferred.is_deferring():
+            deferred.leave(commit=False)
+    
+    def process_response(self, request, response):
+        if deferred.is_deferring():
+            deferred.leave()
+        return response
@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+import datetime
+from south.db import db
+from south.v2 import SchemaMigration
+from django.db import models
+
+
+class Migration(SchemaMigration):
+
+    def forwards(self, orm):
+        # Adding model 'EmailAddress'
+        db.create_table('emailconfirmation_emailaddress', (
+            ('id', self.gf('django.db.models.fields.AutoField')(primary_key=True)),
+            ('user', self.gf('django.db.models.fields.related.ForeignKey')(to=orm['auth.User'])),
+            ('email', self.gf('django.db.models.fields.EmailField')(max_length=75)),
+            ('verified', self.gf('django.db.models.fields.BooleanField')(default=False)),
+            ('primary', self.gf('django.db.models.fields.BooleanField')(default=False)),
+        ))
+        db.send_create_signal('emailconfirmation', ['EmailAddress'])
+
+        # Adding unique constraint on 'EmailAddress', fields ['user', 'email']
+        db.create_unique('emailconfirmation_emailaddress', ['user_id', 'email'])
+
+        # Adding model 'EmailConfirmation'
+        db.create_table('emailconfirmation_emailconfirmation', (
+            ('id', self.gf('django.db.models.fields.AutoField')(primary_key=True)),
+            ('email_address', self.gf('django.db.models.fields.related.ForeignKey')(to=orm['emailconfirmation.EmailAddress'])),
+            ('sent', self.gf('django.db.models.fields.DateTimeField')()),
+            ('confirmation_key', self.gf('django.db.models.fields.CharField')(max_length=40)),
+        ))
+        db.send_create_signal('emailconfirmation', ['EmailConfirmation'])
+
+
+    def backwards(self, orm):
+        # Removing unique constraint on 'EmailAddress', fields ['user', 'email']
+        db.delete_unique('emailconfirmation_emailaddress', ['user_id', 'email'])
+
+        # Deleting model 'EmailAddress'
+        db.delete_table('emailconfirmation_emailaddress')
+
+        # Deleting model 'EmailConfirmation'
+        db.delete_table('emailconfirmation_emailconfirmation')
+
+
+    models = {
+        'auth.group': {
+            'Meta': {'object_name': 'Group'},
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'unique': 'True', 'max_length': '80'}),
+            'permissions': ('django.db.models.fields.related.ManyToManyField', [], {'to': "orm['auth.Permission']", 'symmetrical': 'False', 'blank': 'True'})
+        },
+        'auth.permission': {
+            'Meta': {'ordering': "('content_type__app_label', 'content_type__model', 'codename')", 'unique_together': "(('content_type', 'codename'),)", 'object_name': 'Permission'},
+            'codename': ('django.db.models.fields.CharField', [], {'max_length': '100'}),
+            'content_type': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['contenttypes.ContentType']"}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '50'})
+        },
+        'auth.user': {
+            'Meta': {'object_name': 'User'},
+            'date_joined': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            'email': ('django.db.models.fields.EmailField', [], {'max_length': '75', 'blank': 'True'}),
+            'first_name': ('django.db.models.fields.CharField', [], {'max_length': '30', 'blank': 'True'}),
+            'groups': ('django.db.models.fields.related.ManyToManyField', [], {'to': "orm['auth.Group']", 'symmetrical': 'False', 'blank': 'True'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'is_active': ('django.db.models.fields.BooleanField', [], {'default': 'True'}),
+            'is_staff': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            'is_superuser': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            'last_login': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            'last_name': ('django.db.models.fields.CharField', [], {'max_length': '30', 'blank': 'True'}),
+            'password': ('django.db.models.fields.CharField', [], {'max_length': '128'}),
+            'user_permissions': ('django.db.models.fields.related.ManyToManyField', [], {'to': "orm['auth.Permission']", 'symmetrical': 'False', 'blank': 'True'}),
+            'username': ('django.db.models.fields.CharField', [], {'unique': 'True', 'max_length': '30'})
+        },
+        'contenttypes.contenttype': {
+            'Meta': {'ordering': "('name',)", 'unique_together': "(('app_label', 'model'),)", 'object_name': 'ContentType', 'db_table': "'django_content_type'"},
+            'app_label': ('django.db.models.fields.CharField', [], {'max_length': '100'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'model': ('django.db.models.fields.CharField', [], {'max_length': '100'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '100'})
+        },
+        'emailconfirmation.emailaddress': {
+            'Meta': {'unique_together': "(('user', 'email'),)", 'object_name': 'EmailAddress'},
+            'email': ('django.db.models.fields.EmailField', [], {'max_length': '75'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'primary': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            'user': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['auth.User']"}),
+            'verified': ('django.db.models.fields.BooleanField', [], {'default': 'False'})
+        },
+        'emailconfirmation.emailconfirmation': {
+            'Meta': {'object_name': 'EmailConfirmation'},
+            'confirmation_key': ('django.db.models.fields.CharField', [], {'max_length': '40'}),
+            'email_address': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['emailconfirmation.EmailAddress']"}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'sent': ('django.db.models.fields.DateTimeField', [], {})
+        }
+    }
+
+    complete_apps = ['emailconfirmation']
\ No newline at end of file
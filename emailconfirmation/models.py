@@ -1,9 +1,12 @@
 import datetime
+from collections import namedtuple
 from random import random
 
 from django.conf import settings
-from django.db import models, IntegrityError
-from django.core.mail import send_mail
+from django.core.cache import cache
+from django.db import connections, models, router, transaction, IntegrityError
+from django.db.models import F
+from django.db.models.signals import post_save, post_delete
 from django.core.urlresolvers import reverse, NoReverseMatch
 from django.template.loader import render_to_string
 from django.utils.hashcompat import sha_constructor
@@ -13,33 +16,121 @@ from django.contrib.sites.models import Site
 from django.contrib.auth.models import User
 
 from emailconfirmation.signals import email_confirmed, email_confirmation_sent
-from emailconfirmation import app_settings
+from emailconfirmation import app_settings, deferred, delivery, indexes
 
 # this code based in-part on django-registration
 
+# what the get_*_record(s) lookups return instead of model instances
+EmailRecord = namedtuple("EmailRecord", "user_id email verified primary")
+RECORD_FIELDS = ("user", "email", "verified", "primary")
+
+# compiled SQL of the record lookups, by (lookup, database)
+_record_sql = {}
+
+
 class EmailAddressManager(models.Manager):
     
-    def add_email(self, user, email):
-        email_address, created = self.get_or_create(user=user, email=email)
-        if not created:
+    def add_email(self, user, email, using=None):
+        """
+        Adds ``email`` to ``user`` and sends a confirmation for it, returning
+        the new ``EmailAddress``, or ``None`` if the user already had it.
+        """
+        # insert and let the unique constraint catch duplicates rather than
+        # get_or_create: it saves a SELECT on the usual path, and when
+        # concurrent requests race only the one whose INSERT succeeds goes on
+        # to send a confirmation
+        email_address = self.model(user=user, email=email)
+        if using is None:
+            using = router.db_for_write(self.model, instance=email_address)
+        sid = transaction.savepoint(using=using)
+        try:
+            email_address.save(force_insert=True, using=using)
+        except IntegrityError:
+            transaction.savepoint_rollback(sid, using=using)
             return None
-        EmailConfirmation.objects.send_confirmation(email_address)
+        transaction.savepoint_commit(sid, using=using)
+        EmailConfirmation.objects.send_confirmation(email_address, using=using)
         return email_address
     
-    def get_primary(self, user):
+    def get_primary(self, user, using=None):
         try:
-            return self.get(user=user, primary=True)
+            return self.using(using).get(user=user, primary=True)
         except EmailAddress.DoesNotExist:
             return None
     
-    def get_users_for(self, email):
+    def get_users_for(self, email, using=None):
         """
         returns a list of users with the given email.
         """
         # this is a list rather than a generator because we probably want to
         # do a len() on it right away
-        return [address.user for address in EmailAddress.objects.filter(
+        return [address.user for address in self.using(using).filter(
             verified=True, email=email)]
+    
+    def _record_rows(self, name, build, params, using=None):
+        """
+        Runs the ``values_list`` query made by ``build`` with ``params``.
+        Building a queryset costs more than the query itself on these hot
+        paths, so the SQL is compiled once per lookup and database and reused;
+        ``build`` must apply its filters one at a time, in ``params`` order.
+        """
+        # a None filter compiles to IS NULL, without a placeholder, so it
+        # must never reach the shared SQL; no column here is nullable
+        if None in params:
+            return []
+        if using is None:
+            using = router.db_for_read(self.model)
+        sql = _record_sql.get((name, using))
+        if sql is None:
+            query = build(self.using(using)).query
+            sql = query.get_compiler(using).as_sql()[0]
+            _record_sql[(name, using)] = sql
+        cursor = connections[using].cursor()
+        cursor.execute(sql, params)
+        return cursor.fetchall()
+    
+    def get_primary_record(self, user, using=None):
+        """
+        Like ``get_primary`` but returns an ``EmailRecord``. ``user`` may be a
+        ``User`` or just its id.
+        """
+        user_id = getattr(user, "pk", user)
+        rows = self._record_rows("primary", lambda qs: qs
+            .filter(user=user_id).filter(primary=True)
+            .values_list(*RECORD_FIELDS)[:1], [user_id, True], using)
+        if rows:
+            return EmailRecord._make(rows[0])
+        return None
+    
+    def get_verified_records(self, user, using=None):
+        """
+        Returns ``EmailRecord``s for the verified addresses of ``user`` (a
+        ``User`` or its id), primary first and then alphabetically.
+        """
+        user_id = getattr(user, "pk", user)
+        return map(EmailRecord._make, self._record_rows("verified",
+            lambda qs: qs.filter(user=user_id).filter(verified=True)
+            .order_by("-primary", "email").values_list(*RECORD_FIELDS),
+            [user_id, True], using))
+    
+    def get_user_ids_for(self, email, using=None):
+        """
+        Like ``get_users_for`` but returns user ids only.
+        """
+        return [row[0] for row in self._record_rows("user_ids",
+            lambda qs: qs.filter(email=email).filter(verified=True)
+            .values_list("user"), [email, True], using)]
+    
+    def is_email_available(self, email, using=None):
+        """
+        Returns whether no user has verified ``email`` yet. With
+        ``EMAIL_CONFIRMATION_UNIQUE_VERIFIED`` this is answered from the
+        partial unique index in a single query.
+        """
+        if using is None:
+            using = router.db_for_read(self.model)
+        return not self.using(using).filter(email=email).extra(
+            where=[indexes.verified_predicate(using)]).exists()
 
 
 class EmailAddress(models.Model):
@@ -51,16 +142,22 @@ class EmailAddress(models.Model):
     
     objects = EmailAddressManager()
     
-    def set_as_primary(self, conditional=False):
-        old_primary = EmailAddress.objects.get_primary(self.user)
+    def set_as_primary(self, conditional=False, using=None):
+        # the current primary is read from the database we are about to write
+        # to; a lagging replica could let a user end up with two primaries
+        if using is None:
+            using = router.db_for_write(self.__class__, instance=self)
+        old_primary = EmailAddress.objects.get_primary(self.user, using=using)
         if old_primary:
             if conditional:
                 return False
             old_primary.primary = False
-            old_primary.save()
+            old_primary.save(using=using)
         self.primary = True
-        self.save()
+        self.save(using=using)
         self.user.email = self.email
+        # auth may live on another database than this app; let the routers
+        # decide
         self.user.save()
         return True
     
@@ -77,20 +174,102 @@ class EmailAddress(models.Model):
 
 class EmailConfirmationManager(models.Manager):
     
-    def confirm_email(self, confirmation_key):
+    def confirm_email(self, confirmation_key, using=None):
+        if app_settings.EMAIL_CONFIRMATION_CACHE:
+            cached = self._cached_confirmation(confirmation_key, using)
+        else:
+            cached = None
+        if cached is not None:
+            confirmation_id, site_id, email_address = cached
+        else:
+            try:
+                confirmation = self.using(using).get(
+                    confirmation_key=confirmation_key,
+                    expires_at__gt=datetime.datetime.now())
+            except self.model.DoesNotExist:
+                return None
+            confirmation_id = confirmation.pk
+            site_id = confirmation.site_id
+            email_address = confirmation.email_address
+        # with EMAIL_CONFIRMATION_UNIQUE_VERIFIED the index turns away the
+        # loser of two users confirming the same email at once
+        if using is None:
+            using = router.db_for_write(EmailAddress, instance=email_address)
+        email_address.verified = True
+        sid = transaction.savepoint(using=using)
         try:
-            confirmation = self.get(confirmation_key=confirmation_key)
-        except self.model.DoesNotExist:
+            email_address.save(using=using)
+        except IntegrityError:
+            transaction.savepoint_rollback(sid, using=using)
+            email_address.verified = False
+            return None
+        transaction.savepoint_commit(sid, using=using)
+        email_address.set_as_primary(conditional=True, using=using)
+        # only the first use of a key counts as a confirmation
+        if self.using(using).filter(pk=confirmation_id,
+                confirmed_at__isnull=True).update(
+                confirmed_at=datetime.datetime.now()):
+            ConfirmationCount.objects.increment("confirmed", site=site_id,
+                                                using=using)
+        self.uncache_confirmation(confirmation_key)
+        deferred.send_signal(email_confirmed, sender=self.model,
+                             email_address=email_address)
+        return email_address
+    
+    def _cached_confirmation(self, confirmation_key, using=None):
+        """
+        Resolves a confirmation key through the cache, returning the
+        confirmation's id, its site's id and the ``EmailAddress`` it confirms
+        or ``None`` on a cache miss.
+        """
+        record = cache.get(confirmation_cache_key(confirmation_key))
+        if record is None:
+            return None
+        confirmation_id, email_address_id, user_id, expires, site_id = record
+        if expires <= datetime.datetime.now():
+            self.uncache_confirmation(confirmation_key)
+            return None
+        # joining the confirmation in checks it still exists, so an entry
+        # left behind by a rolled back send (whose id may since have been
+        # reused) counts as a miss
+        try:
+            return confirmation_id, site_id, EmailAddress.objects.using(using)\
+                .select_related("user").get(pk=email_address_id,
+                                            emailconfirmation__pk=confirmation_id)
+        except EmailAddress.DoesNotExist:
+            self.uncache_confirmation(confirmation_key)
             return None
-        if not confirmation.key_expired():
-            email_address = confirmation.email_address
-            email_address.verified = True
-            email_address.set_as_primary(conditional=True)
-            email_address.save()
-            email_confirmed.send(sender=self.model, email_address=email_address)
-            return email_address
     
-    def send_confirmation(self, email_address):
+    def cache_confirmation(self, confirmation):
+        if not app_settings.EMAIL_CONFIRMATION_CACHE:
+            return
+        expires = confirmation.expires_at
+        delta = expires - datetime.datetime.now()
+        timeout = delta.days * 86400 + delta.seconds
+        if timeout <= 0:
+            self.uncache_confirmation(confirmation.confirmation_key)
+            return
+        record = (
+            confirmation.pk,
+            confirmation.email_address_id,
+            confirmation.email_address.user_id,
+            expires,
+            confirmation.site_id,
+        )
+        cache.set(confirmation_cache_key(confirmation.confirmation_key),
+                  record, timeout)
+    
+    def uncache_confirmation(self, confirmation_key):
+        if app_settings.EMAIL_CONFIRMATION_CACHE:
+            cache.delete(confirmation_cache_key(confirmation_key))
+    
+    def send_confirmation(self, email_address, days=None, using=None):
+        """
+        Sends a confirmation email to ``email_address``. The key is good for
+        ``days`` days, defaulting to ``EMAIL_CONFIRMATION_DAYS``.
+        """
+        if days is None:
+            days = app_settings.EMAIL_CONFIRMATION_DAYS
         salt = sha_constructor(str(random())).hexdigest()[:5]
         confirmation_key = sha_constructor(salt + email_address.email).hexdigest()
         current_site = Site.objects.get_current()
@@ -121,36 +300,63 @@ class EmailConfirmationManager(models.Manager):
         subject = "".join(subject.splitlines())
         message = render_to_string(
             "emailconfirmation/email_confirmation_message.txt", context)
-        send_mail(subject, message, settings.DEFAULT_FROM_EMAIL, [email_address.email])
-        confirmation = self.create(
+        delivery.send_mail(subject, message, settings.DEFAULT_FROM_EMAIL,
+                           [email_address.email])
+        sent = datetime.datetime.now()
+        confirmation = self.using(using).create(
             email_address=email_address,
-            sent=datetime.datetime.now(),
+            site=current_site,
+            sent=sent,
+            expires_at=sent + datetime.timedelta(days=days),
             confirmation_key=confirmation_key
         )
-        email_confirmation_sent.send(
+        ConfirmationCount.objects.increment("sent", site=current_site,
+                                            using=using)
+        deferred.send_signal(email_confirmation_sent,
             sender=self.model,
             confirmation=confirmation,
         )
         return confirmation
     
-    def delete_expired_confirmations(self):
-        for confirmation in self.all():
-            if confirmation.key_expired():
-                confirmation.delete()
+    def delete_expired_confirmations(self, using=None):
+        # count and delete on the same database, or a lagging replica would
+        # throw the expired counter off
+        if using is None:
+            using = router.db_for_write(self.model)
+        expired = self.using(using).filter(
+            expires_at__lte=datetime.datetime.now())
+        # keys that were never used count towards their site on the day they
+        # expired
+        days = {}
+        for site_id, expires_at in expired.filter(confirmed_at__isnull=True)\
+                .values_list("site", "expires_at").iterator():
+            key = (site_id, expires_at.date())
+            days[key] = days.get(key, 0) + 1
+        expired.delete()
+        for (site_id, day), count in days.items():
+            ConfirmationCount.objects.increment("expired", count, day=day,
+                                                site=site_id, using=using)
 
 
 class EmailConfirmation(models.Model):
     
     email_address = models.ForeignKey(EmailAddress)
-    sent = models.DateTimeField()
-    confirmation_key = models.CharField(max_length=40)
+    site = models.ForeignKey(Site)
+    sent = models.DateTimeField(db_index=True)
+    expires_at = models.DateTimeField(db_index=True)
+    confirmed_at = models.DateTimeField(null=True, blank=True, db_index=True)
+    confirmation_key = models.CharField(max_length=40, db_index=True)
     
     objects = EmailConfirmationManager()
     
+    def save(self, *args, **kwargs):
+        if self.expires_at is None:
+            self.expires_at = self.sent + datetime.timedelta(
+                days=app_settings.EMAIL_CONFIRMATION_DAYS)
+        super(EmailConfirmation, self).save(*args, **kwargs)
+    
     def key_expired(self):
-        expiration_date = self.sent + datetime.timedelta(
-            days=app_settings.EMAIL_CONFIRMATION_DAYS)
-        return expiration_date <= datetime.datetime.now()
+        return self.expires_at <= datetime.datetime.now()
     key_expired.boolean = True
     
     def __unicode__(self):
@@ -159,3 +365,118 @@ class EmailConfirmation(models.Model):
     class Meta:
         verbose_name = _("email confirmation")
         verbose_name_plural = _("email confirmations")
+
+
+class ConfirmationCountManager(models.Manager):
+    
+    def increment(self, field, amount=1, day=None, site=None, using=None):
+        """
+        Adds ``amount`` to the ``field`` counter ("sent", "confirmed" or
+        "expired") of ``site`` (a ``Site`` or its id) on ``day``, defaulting
+        to the current site today.
+        """
+        if day is None:
+            day = datetime.date.today()
+        if site is None:
+            site = Site.objects.get_current()
+        site_id = getattr(site, "pk", site)
+        if using is None:
+            using = router.db_for_write(self.model)
+        counts = self.using(using).filter(site=site_id, day=day)
+        if counts.update(**{field: F(field) + amount}):
+            return
+        # first event of the day; if someone else creates the row first the
+        # unique constraint sends us back to the update
+        sid = transaction.savepoint(using=using)
+        try:
+            self.using(using).create(site_id=site_id, day=day,
+                                     **{field: amount})
+        except IntegrityError:
+            transaction.savepoint_rollback(sid, using=using)
+            counts.update(**{field: F(field) + amount})
+        else:
+            transaction.savepoint_commit(sid, using=using)
+    
+    def rebuild(self, since=None, site=None, using=None):
+        """
+        Recomputes the sent and confirmed counters from ``since`` onwards from
+        the confirmations still in the database, for ``site`` (a ``Site`` or
+        its id) or every site, returning the number of site-days rebuilt.
+        Expiries are only known to ``delete_expired_confirmations``, which
+        deletes the rows, so expired counters are left alone; likewise days
+        whose confirmations have been purged will come out low, which is why
+        ``since`` defaults to the day of the oldest confirmation left.
+        """
+        if using is None:
+            using = router.db_for_write(self.model)
+        confirmations = EmailConfirmation.objects.using(using)
+        counts = self.using(using)
+        if site is not None:
+            confirmations = confirmations.filter(site=getattr(site, "pk", site))
+            counts = counts.filter(site=getattr(site, "pk", site))
+        if since is None:
+            try:
+                since = confirmations.order_by("sent")\
+                    .values_list("sent", flat=True)[0].date()
+            except IndexError:
+                return 0
+        start = datetime.datetime.combine(since, datetime.time())
+        totals = {}
+        for site_id, sent in confirmations.filter(sent__gte=start)\
+                .values_list("site", "sent").iterator():
+            totals.setdefault((site_id, sent.date()), [0, 0])[0] += 1
+        for site_id, confirmed_at in confirmations\
+                .filter(confirmed_at__gte=start)\
+                .values_list("site", "confirmed_at").iterator():
+            totals.setdefault((site_id, confirmed_at.date()), [0, 0])[1] += 1
+        counts = counts.filter(day__gte=since)
+        for site_id, day in counts.values_list("site", "day"):
+            totals.setdefault((site_id, day), [0, 0])
+        for (site_id, day), (sent, confirmed) in totals.items():
+            if not counts.filter(site=site_id, day=day).update(
+                    sent=sent, confirmed=confirmed):
+                self.using(using).create(site_id=site_id, day=day, sent=sent,
+                                         confirmed=confirmed)
+        return len(totals)
+
+
+class ConfirmationCount(models.Model):
+    """
+    Daily totals of confirmations sent, confirmed and expired unused, kept up
+    to date as they happen so reports need not count the raw tables.
+    """
+    
+    site = models.ForeignKey(Site)
+    day = models.DateField()
+    sent = models.PositiveIntegerField(default=0)
+    confirmed = models.PositiveIntegerField(default=0)
+    expired = models.PositiveIntegerField(default=0)
+    
+    objects = ConfirmationCountManager()
+    
+    def __unicode__(self):
+        return u"%s on %s" % (self.site, self.day)
+    
+    class Meta:
+        verbose_name = _("confirmation count")
+        verbose_name_plural = _("confirmation counts")
+        unique_together = (
+            ("site", "day"),
+        )
+
+
+def confirmation_cache_key(confirmation_key):
+    return "%s:%s" % (app_settings.EMAIL_CONFIRMATION_CACHE_PREFIX,
+                      confirmation_key)
+
+
+def cache_confirmation(sender, instance, **kwargs):
+    # only once the row is committed, so a rolled back key is never cached
+    deferred.call_after_commit(EmailConfirmation.objects.cache_confirmation,
+                               instance)
+post_save.connect(cache_confirmation, sender=EmailConfirmation)
+
+
+def uncache_confirmation(sender, instance, **kwargs):
+    EmailConfirmation.objects.uncache_confirmation(instance.confirmation_key)
+post_delete.connect(uncache_confirmation, sender=EmailConfirmation)
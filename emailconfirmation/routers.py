@@ -0,0 +1,96 @@
+"""
+Database routing for sites that read from replicas.
+
+``ReplicaRouter`` sends reads for the routed apps to one of
+``EMAIL_CONFIRMATION_READ_DATABASES`` and writes to
+``EMAIL_CONFIRMATION_PRIMARY_DATABASE``. Whenever a user's rows are written
+(confirming an address, ``set_as_primary``) that user is pinned to the
+primary for ``EMAIL_CONFIRMATION_PIN_SECONDS`` so they always read their own
+writes. Pins live in Django's cache so they hold across processes; add
+``emailconfirmation.middleware.ReplicaPinningMiddleware`` to tell the router
+which user the current request belongs to.
+"""
+import random
+import threading
+
+from django.core.cache import cache
+
+from django.contrib.auth.models import User
+
+from emailconfirmation import app_settings
+
+
+_local = threading.local()
+
+
+def _pin_key(user_id):
+    return "%s:pin:%s" % (app_settings.EMAIL_CONFIRMATION_CACHE_PREFIX,
+                          user_id)
+
+
+def set_current_user(user_id):
+    """
+    Sets the user whose reads the router is serving in this thread, or
+    ``None`` for anonymous work.
+    """
+    _local.user_id = user_id
+    _local.pinned = (user_id is not None and
+                     cache.get(_pin_key(user_id)) is not None)
+
+
+def pin_user(user_id):
+    """
+    Sends the given user's reads to the primary for the next
+    ``EMAIL_CONFIRMATION_PIN_SECONDS``.
+    """
+    cache.set(_pin_key(user_id), True,
+              app_settings.EMAIL_CONFIRMATION_PIN_SECONDS)
+    if user_id == getattr(_local, "user_id", None):
+        _local.pinned = True
+
+
+def is_pinned():
+    return getattr(_local, "pinned", False)
+
+
+class ReplicaRouter(object):
+    
+    def _routed(self, model):
+        return (model._meta.app_label in
+                app_settings.EMAIL_CONFIRMATION_ROUTED_APPS)
+    
+    def db_for_read(self, model, **hints):
+        replicas = app_settings.EMAIL_CONFIRMATION_READ_DATABASES
+        if not self._routed(model) or not replicas:
+            return None
+        if is_pinned():
+            return app_settings.EMAIL_CONFIRMATION_PRIMARY_DATABASE
+        return random.choice(replicas)
+    
+    def db_for_write(self, model, **hints):
+        if not self._routed(model):
+            return None
+        instance = hints.get("instance")
+        if isinstance(instance, User):
+            user_id = instance.pk
+        else:
+            user_id = getattr(instance, "user_id", None)
+        if user_id is None:
+            user_id = getattr(_local, "user_id", None)
+        if user_id is not None:
+            pin_user(user_id)
+        return app_settings.EMAIL_CONFIRMATION_PRIMARY_DATABASE
+    
+    def allow_relation(self, obj1, obj2, **hints):
+        # replicas hold the same rows as the primary
+        databases = [app_settings.EMAIL_CONFIRMATION_PRIMARY_DATABASE]
+        databases.extend(app_settings.EMAIL_CONFIRMATION_READ_DATABASES)
+        if obj1._state.db in databases and obj2._state.db in databases:
+            return True
+        return None
+    
+    def allow_syncdb(self, db, model):
+        if (self._routed(model) and
+                db in app_settings.EMAIL_CONFIRMATION_READ_DATABASES):
+            return False
+        return None
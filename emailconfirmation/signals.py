@@ -3,3 +3,8 @@ from django.dispatch import Signal
 
 email_confirmed = Signal(providing_args=["email_address"])
 email_confirmation_sent = Signal(providing_args=["confirmation"])
+
+# sent alongside the signals above with every event they carried, in lists of
+# up to EMAIL_CONFIRMATION_SIGNAL_BATCH_SIZE; see emailconfirmation.deferred
+email_confirmed_batch = Signal(providing_args=["email_addresses"])
+email_confirmation_sent_batch = Signal(providing_args=["confirmations"])
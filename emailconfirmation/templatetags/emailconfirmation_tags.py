@@ -7,15 +7,18 @@ register = template.Library()
 
 
 @register.filter
-def verified_emails(user):
+def verified_emails(user, using=None):
     """
     This filter returns a list of verified emails for a user.
 
-    The emails are ordered by primary first and then alphabetically.
+    The emails are ordered by primary first and then alphabetically. An
+    optional argument names the database to read from, e.g.
+    ``user|verified_emails:"replica"``; otherwise the routers decide.
 
     If the user is not authenticated, this will still return an empty queryset.
     """
     if not isinstance(user, User):
         return models.EmailAddress.objects.none()
-    return models.EmailAddress.objects.filter(user=user, verified=True)\
+    return models.EmailAddress.objects.using(using)\
+        .filter(user=user, verified=True)\
         .order_by('-primary', 'email')
@@ -0,0 +1,74 @@
+"""
+A local SMTP server for exercising real SMTP connections in tests.
+"""
+import asyncore
+import smtpd
+import threading
+import time
+
+
+class SMTPSink(smtpd.SMTPServer):
+    """
+    Accepts every message and keeps it in ``messages`` as
+    ``(mailfrom, rcpttos, data)``. ``connections`` counts the SMTP sessions
+    that have been opened against it.
+    """
+    
+    def __init__(self, host="127.0.0.1", port=0):
+        smtpd.SMTPServer.__init__(self, (host, port), None)
+        self.host, self.port = self.socket.getsockname()
+        self.messages = []
+        self.connections = 0
+        self._condition = threading.Condition()
+        self._running = False
+        self._thread = None
+    
+    def handle_accept(self):
+        self.connections += 1
+        smtpd.SMTPServer.handle_accept(self)
+    
+    def process_message(self, peer, mailfrom, rcpttos, data):
+        self._condition.acquire()
+        try:
+            self.messages.append((mailfrom, rcpttos, data))
+            self._condition.notifyAll()
+        finally:
+            self._condition.release()
+    
+    def wait_for(self, recipient, timeout=10):
+        """
+        Returns the data of the first message sent to ``recipient``, waiting
+        up to ``timeout`` seconds for it to arrive, or ``None``.
+        """
+        deadline = time.time() + timeout
+        self._condition.acquire()
+        try:
+            while True:
+                for mailfrom, rcpttos, data in self.messages:
+                    if recipient in rcpttos:
+                        return data
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return None
+                self._condition.wait(remaining)
+        finally:
+            self._condition.release()
+    
+    def start(self):
+        self._running = True
+        self._thread = threading.Thread(target=self._serve)
+        self._thread.setDaemon(True)
+        self._thread.start()
+    
+    def _serve(self):
+        while self._running:
+            asyncore.loop(timeout=0.01, count=1)
+    
+    def stop(self):
+        self._running = False
+        self._thread.join()
+        self.close()
+        # drop any sessions still open against us
+        for channel in asyncore.socket_map.values():
+            if isinstance(channel, smtpd.SMTPChannel):
+                channel.close()
@@ -1,16 +1,26 @@
 import datetime
 import os
+import tempfile
+import threading
+import time
 
 from django.conf import settings
 from django.core import mail
+from django.core.cache import cache
+from django.core.management import call_command
+from django.http import HttpRequest, HttpResponse
 from django.core.urlresolvers import reverse
-from django.test import TestCase
+from django.db import connection, router, transaction
+from django.test import TestCase, TransactionTestCase
 from django.test.signals import template_rendered
 
-from django.contrib.auth.models import User
+from django.contrib.auth.models import AnonymousUser, User
 from django.contrib.sites.models import Site
 
-from emailconfirmation import models, signals, app_settings
+from emailconfirmation import models, signals, app_settings, routers, delivery, deferred, indexes
+from emailconfirmation.middleware import DeferredMiddleware, ReplicaPinningMiddleware
+from emailconfirmation.templatetags.emailconfirmation_tags import verified_emails
+from emailconfirmation.tests.smtp import SMTPSink
 
 
 
@@ -125,6 +135,70 @@ class EmailAddressManagerTests(EmailConfirmationTestCase):
         self.assertEqual(set(result), set([scooby, self.user]))
 
 
+    def test_get_primary_record(self):
+        """
+        ``get_primary_record`` returns the primary address as an
+        ``EmailRecord``, for a user or a user id.
+
+        """
+        models.EmailAddress.objects.create(user=self.user, email=self.email, primary=True, verified=True)
+        models.EmailAddress.objects.create(user=self.user, email="other@example.com")
+
+        record = models.EmailAddress.objects.get_primary_record(self.user)
+
+        self.assertEqual(record, (self.user.pk, self.email, True, True))
+        self.assertEqual(record.email, self.email)
+        self.assertEqual(models.EmailAddress.objects.get_primary_record(self.user.pk), record)
+
+
+    def test_get_primary_record_none(self):
+        models.EmailAddress.objects.create(user=self.user, email=self.email)
+
+        self.assertEqual(models.EmailAddress.objects.get_primary_record(self.user), None)
+
+
+    def test_get_verified_records(self):
+        models.EmailAddress.objects.create(user=self.user, email="b@example.com", verified=True)
+        models.EmailAddress.objects.create(user=self.user, email="c@example.com", verified=True, primary=True)
+        models.EmailAddress.objects.create(user=self.user, email="a@example.com", verified=True)
+        models.EmailAddress.objects.create(user=self.user, email="unverified@example.com")
+
+        result = models.EmailAddress.objects.get_verified_records(self.user)
+
+        self.assertEqual([r.email for r in result],
+                         ["c@example.com", "a@example.com", "b@example.com"])
+
+
+    def test_get_user_ids_for(self):
+        scooby = User.objects.create(username="scooby")
+        shaggy = User.objects.create(username="shaggy")
+        models.EmailAddress.objects.create(user=self.user, email=self.email, verified=True)
+        models.EmailAddress.objects.create(user=scooby, email=self.email, verified=True)
+        models.EmailAddress.objects.create(user=shaggy, email=self.email)
+
+        result = models.EmailAddress.objects.get_user_ids_for(self.email)
+
+        self.assertEqual(set(result), set([self.user.pk, scooby.pk]))
+
+
+    def test_record_lookups_none_first(self):
+        """
+        A lookup for ``None`` (e.g. an anonymous user's id) finds nothing and
+        does not break the compiled SQL for later calls.
+
+        """
+        models.EmailAddress.objects.create(user=self.user, email=self.email, primary=True, verified=True)
+        models._record_sql.clear()
+
+        self.assertEqual(models.EmailAddress.objects.get_primary_record(None), None)
+        self.assertEqual(models.EmailAddress.objects.get_verified_records(None), [])
+        self.assertEqual(models.EmailAddress.objects.get_user_ids_for(None), [])
+
+        self.assertEqual(models.EmailAddress.objects.get_primary_record(self.user).email, self.email)
+        self.assertEqual(len(models.EmailAddress.objects.get_verified_records(self.user)), 1)
+        self.assertEqual(models.EmailAddress.objects.get_user_ids_for(self.email), [self.user.pk])
+
+
     def test_get_users_for_unverified(self):
         """
         ``get_users_for`` does not return users who have the given
@@ -142,6 +216,144 @@ class EmailAddressManagerTests(EmailConfirmationTestCase):
 
 
 
+class AddEmailContentionTests(TransactionTestCase):
+
+    def test_concurrent_add_email(self):
+        """
+        When several requests add the same address at once, exactly one
+        creates it and exactly one confirmation is sent. (Django's own
+        ``get_or_create`` passes this too; ``test_insert_without_select``
+        covers what the direct insert changes.)
+
+        """
+        user = User.objects.create(username="daphne")
+        email = "daphne@example.com"
+        start = threading.Event()
+        results = []
+        errors = []
+        def add():
+            start.wait(5)
+            try:
+                try:
+                    results.append(models.EmailAddress.objects.add_email(user, email))
+                except Exception, e:
+                    errors.append(e)
+            finally:
+                connection.close()
+        threads = [threading.Thread(target=add) for n in range(8)]
+        for thread in threads:
+            thread.start()
+        start.set()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(errors, [])
+        self.assertEqual(len([r for r in results if r is not None]), 1)
+        self.assertEqual(models.EmailAddress.objects.filter(user=user, email=email).count(), 1)
+        self.assertEqual(models.EmailConfirmation.objects.count(), 1)
+        self.assertEqual(len(mail.outbox), 1)
+
+
+    def test_insert_without_select(self):
+        """
+        Adding an address goes straight to the INSERT, with no SELECT
+        beforehand, whether it wins or loses.
+
+        """
+        user = User.objects.create(username="daphne")
+        email = "daphne@example.com"
+        old_DEBUG = settings.DEBUG
+        settings.DEBUG = True
+        try:
+            connection.queries = []
+            models.EmailAddress.objects.add_email(user, email)
+            added = [q["sql"] for q in connection.queries]
+            connection.queries = []
+            models.EmailAddress.objects.add_email(user, email)
+            duplicate = [q["sql"] for q in connection.queries]
+        finally:
+            settings.DEBUG = old_DEBUG
+
+        for queries in (added, duplicate):
+            self.assertEqual([sql for sql in queries
+                              if sql.startswith("SELECT") and "emailconfirmation_emailaddress" in sql], [])
+        self.assertEqual(len(mail.outbox), 1)
+
+
+
+class UniqueVerifiedEmailTests(TransactionTestCase):
+
+    def setUp(self):
+        self._old_unique = app_settings.EMAIL_CONFIRMATION_UNIQUE_VERIFIED
+        app_settings.EMAIL_CONFIRMATION_UNIQUE_VERIFIED = True
+        indexes.create_indexes()
+        self.email = "daphne@example.com"
+        self.daphne = User.objects.create(username="daphne")
+        self.scooby = User.objects.create(username="scooby")
+
+
+    def tearDown(self):
+        indexes.drop_unique_verified_index()
+        app_settings.EMAIL_CONFIRMATION_UNIQUE_VERIFIED = self._old_unique
+
+
+    def _key(self, user):
+        address = models.EmailAddress.objects.add_email(user, self.email)
+        return models.EmailConfirmation.objects.get(email_address=address).confirmation_key
+
+
+    def test_is_email_available(self):
+        models.EmailAddress.objects.create(user=self.daphne, email=self.email)
+        self.assertTrue(models.EmailAddress.objects.is_email_available(self.email))
+
+        models.EmailAddress.objects.filter(user=self.daphne).update(verified=True)
+        self.assertFalse(models.EmailAddress.objects.is_email_available(self.email))
+
+
+    def test_unverified_duplicates_allowed(self):
+        models.EmailAddress.objects.create(user=self.daphne, email=self.email)
+        models.EmailAddress.objects.create(user=self.scooby, email=self.email)
+
+        self.assertEqual(models.EmailAddress.objects.filter(email=self.email).count(), 2)
+
+
+    def test_confirm_taken_email(self):
+        """
+        ``confirm_email`` returns ``None`` when another user has verified the
+        address in the meantime.
+
+        """
+        daphne_key = self._key(self.daphne)
+        scooby_key = self._key(self.scooby)
+
+        self.assertNotEqual(models.EmailConfirmation.objects.confirm_email(daphne_key), None)
+        self.assertEqual(models.EmailConfirmation.objects.confirm_email(scooby_key), None)
+        self.assertEqual(models.EmailAddress.objects.get_users_for(self.email), [self.daphne])
+        self.assertEqual(models.EmailAddress.objects.get_primary(self.scooby), None)
+
+
+    def test_concurrent_confirmations(self):
+        keys = [self._key(self.daphne), self._key(self.scooby)]
+        start = threading.Event()
+        results = []
+        def confirm(key):
+            start.wait(5)
+            try:
+                results.append(models.EmailConfirmation.objects.confirm_email(key))
+            finally:
+                connection.close()
+        threads = [threading.Thread(target=confirm, args=(key,)) for key in keys]
+        for thread in threads:
+            thread.start()
+        start.set()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len([r for r in results if r is not None]), 1)
+        self.assertEqual(len(models.EmailAddress.objects.get_users_for(self.email)), 1)
+
+
+
 class EmailAddressTests(EmailConfirmationTestCase):
 
     def test_set_as_primary(self):
@@ -285,6 +497,7 @@ class EmailConfirmationManagerTests(EmailConfirmationTestCase):
         address = models.EmailAddress.objects.add_email(self.user, self.email)
         confirmation = models.EmailConfirmation.objects.get(email_address=address)
         confirmation.sent = confirmation.sent - datetime.timedelta(days=15)
+        confirmation.expires_at = confirmation.expires_at - datetime.timedelta(days=15)
         confirmation.save()
 
         result = models.EmailConfirmation.objects.confirm_email(confirmation.confirmation_key)
@@ -323,6 +536,21 @@ class EmailConfirmationManagerTests(EmailConfirmationTestCase):
             models.settings.DEFAULT_HTTP_PROTOCOL = _old_default_protocol
 
 
+    def test_send_confirmation_expires_at(self):
+        """
+        ``send_confirmation`` stores when the key expires, by default
+        ``EMAIL_CONFIRMATION_DAYS`` after it was sent.
+
+        """
+        address = models.EmailAddress.objects.create(user=self.user, email=self.email)
+
+        confirmation = models.EmailConfirmation.objects.send_confirmation(address)
+        self.assertEqual(confirmation.expires_at, confirmation.sent + datetime.timedelta(days=14))
+
+        confirmation = models.EmailConfirmation.objects.send_confirmation(address, days=1)
+        self.assertEqual(confirmation.expires_at, confirmation.sent + datetime.timedelta(days=1))
+
+
     def test_send_confirmation_respects_DEFAULT_HTTP_PROTOCOL(self):
         """
         ``send_confirmation`` generates a confirmation URL with the protocol
@@ -343,6 +571,19 @@ class EmailConfirmationManagerTests(EmailConfirmationTestCase):
             models.settings.DEFAULT_HTTP_PROTOCOL = _old_default_protocol
 
 
+    def test_confirm_email_short_lifetime(self):
+        """
+        ``confirm_email`` honours a per-confirmation lifetime.
+
+        """
+        address = models.EmailAddress.objects.create(user=self.user, email=self.email)
+        confirmation = models.EmailConfirmation.objects.send_confirmation(address, days=0)
+
+        result = models.EmailConfirmation.objects.confirm_email(confirmation.confirmation_key)
+
+        self.assertEqual(result, None)
+
+
     def test_delete_expired_confirmations(self):
         """
         ``delete_expired_confirmations`` does just that.
@@ -351,6 +592,7 @@ class EmailConfirmationManagerTests(EmailConfirmationTestCase):
         address = models.EmailAddress.objects.add_email(self.user, self.email)
         confirmation = models.EmailConfirmation.objects.get(email_address=address)
         confirmation.sent = confirmation.sent - datetime.timedelta(days=15)
+        confirmation.expires_at = confirmation.expires_at - datetime.timedelta(days=15)
         confirmation.save()
 
         models.EmailConfirmation.objects.delete_expired_confirmations()
@@ -373,6 +615,7 @@ class EmailConfirmationTests(EmailConfirmationTestCase):
         self.assertEqual(confirmation.key_expired(), False)
 
         confirmation.sent = confirmation.sent - datetime.timedelta(days=15)
+        confirmation.expires_at = confirmation.expires_at - datetime.timedelta(days=15)
         confirmation.save()
 
         self.assertEqual(confirmation.key_expired(), True)
@@ -386,6 +629,959 @@ class EmailConfirmationTests(EmailConfirmationTestCase):
 
 
 
+class ConfirmationCacheTests(EmailConfirmationTestCase):
+
+    def setUp(self):
+        super(ConfirmationCacheTests, self).setUp()
+        self._old_cache = app_settings.EMAIL_CONFIRMATION_CACHE
+        app_settings.EMAIL_CONFIRMATION_CACHE = True
+
+
+    def tearDown(self):
+        app_settings.EMAIL_CONFIRMATION_CACHE = self._old_cache
+        super(ConfirmationCacheTests, self).tearDown()
+
+
+    def _cached(self, confirmation):
+        return cache.get(models.confirmation_cache_key(confirmation.confirmation_key))
+
+
+    def test_send_confirmation_caches_key(self):
+        """
+        ``send_confirmation`` writes the new key through to the cache.
+
+        """
+        address = models.EmailAddress.objects.create(user=self.user, email=self.email)
+        confirmation = models.EmailConfirmation.objects.send_confirmation(address)
+
+        record = self._cached(confirmation)
+
+        self.assertEqual(record[:3], (confirmation.pk, address.pk, self.user.pk))
+        self.assertEqual(record[3], confirmation.sent + datetime.timedelta(days=14))
+
+
+    def test_confirm_email_uses_cache(self):
+        """
+        ``confirm_email`` resolves a cached key without looking it up in the
+        database, and evicts it once confirmed.
+
+        """
+        address = models.EmailAddress.objects.add_email(self.user, self.email)
+        confirmation = models.EmailConfirmation.objects.get(email_address=address)
+        # an update() bypasses the signals, so only the cache knows the key now
+        models.EmailConfirmation.objects.filter(pk=confirmation.pk).update(confirmation_key="junk")
+
+        result = models.EmailConfirmation.objects.confirm_email(confirmation.confirmation_key)
+
+        self.assertEqual(result, address)
+        self.assertEqual(models.EmailAddress.objects.get(pk=address.pk).verified, True)
+        self.assertEqual(self._cached(confirmation), None)
+
+
+    def test_confirm_email_cache_miss(self):
+        """
+        ``confirm_email`` falls back to the database on a cache miss.
+
+        """
+        address = models.EmailAddress.objects.add_email(self.user, self.email)
+        confirmation = models.EmailConfirmation.objects.get(email_address=address)
+        cache.delete(models.confirmation_cache_key(confirmation.confirmation_key))
+
+        result = models.EmailConfirmation.objects.confirm_email(confirmation.confirmation_key)
+
+        self.assertEqual(result, address)
+
+
+    def test_expired_key_evicted(self):
+        """
+        Saving a confirmation whose key has expired evicts it from the cache.
+
+        """
+        address = models.EmailAddress.objects.add_email(self.user, self.email)
+        confirmation = models.EmailConfirmation.objects.get(email_address=address)
+        confirmation.sent = confirmation.sent - datetime.timedelta(days=15)
+        confirmation.expires_at = confirmation.expires_at - datetime.timedelta(days=15)
+        confirmation.save()
+
+        self.assertEqual(self._cached(confirmation), None)
+        self.assertEqual(models.EmailConfirmation.objects.confirm_email(confirmation.confirmation_key), None)
+
+
+    def test_cached_after_commit(self):
+        """
+        Inside a ``deferred`` block the key is cached once the block commits,
+        and not at all if it rolls back.
+
+        """
+        address = models.EmailAddress.objects.create(user=self.user, email=self.email)
+        def send():
+            confirmation = models.EmailConfirmation.objects.send_confirmation(address)
+            self.assertEqual(self._cached(confirmation), None)
+            return confirmation
+        confirmation = deferred.deferred(send)()
+        self.assertNotEqual(self._cached(confirmation), None)
+
+        sent = []
+        def send_and_fail():
+            sent.append(models.EmailConfirmation.objects.send_confirmation(address))
+            raise ValueError
+        self.assertRaises(ValueError, deferred.deferred(send_and_fail))
+        self.assertEqual(self._cached(sent[0]), None)
+
+
+    def test_stale_entry_is_a_miss(self):
+        """
+        A cached key whose row is gone (e.g. its send was rolled back) does
+        not confirm anything.
+
+        """
+        address = models.EmailAddress.objects.add_email(self.user, self.email)
+        confirmation = models.EmailConfirmation.objects.get(email_address=address)
+        # raw SQL, as a rollback would, so no signal evicts the key
+        connection.cursor().execute(
+            "DELETE FROM emailconfirmation_emailconfirmation WHERE id = %s", [confirmation.pk])
+        self.assertNotEqual(self._cached(confirmation), None)
+
+        result = models.EmailConfirmation.objects.confirm_email(confirmation.confirmation_key)
+
+        self.assertEqual(result, None)
+        self.assertEqual(models.EmailAddress.objects.get(pk=address.pk).verified, False)
+        self.assertEqual(self._cached(confirmation), None)
+
+
+    def test_delete_expired_confirmations_evicts(self):
+        """
+        ``delete_expired_confirmations`` evicts the keys it deletes.
+
+        """
+        address = models.EmailAddress.objects.add_email(self.user, self.email)
+        confirmation = models.EmailConfirmation.objects.get(email_address=address)
+        models.EmailConfirmation.objects.filter(pk=confirmation.pk).update(
+            sent=confirmation.sent - datetime.timedelta(days=15),
+            expires_at=confirmation.expires_at - datetime.timedelta(days=15))
+
+        models.EmailConfirmation.objects.delete_expired_confirmations()
+
+        self.assertEqual(self._cached(confirmation), None)
+
+
+
+class ReplicaRouterTests(EmailConfirmationTestCase):
+
+    def setUp(self):
+        super(ReplicaRouterTests, self).setUp()
+        self._old_read_databases = app_settings.EMAIL_CONFIRMATION_READ_DATABASES
+        app_settings.EMAIL_CONFIRMATION_READ_DATABASES = ("replica",)
+        self.router = routers.ReplicaRouter()
+        cache.delete(routers._pin_key(self.user.pk))
+
+
+    def tearDown(self):
+        app_settings.EMAIL_CONFIRMATION_READ_DATABASES = self._old_read_databases
+        routers.set_current_user(None)
+        cache.delete(routers._pin_key(self.user.pk))
+        super(ReplicaRouterTests, self).tearDown()
+
+
+    def test_reads_go_to_replica(self):
+        routers.set_current_user(self.user.pk)
+
+        self.assertEqual(self.router.db_for_read(models.EmailAddress), "replica")
+        self.assertEqual(self.router.db_for_write(models.EmailAddress), "default")
+
+
+    def test_unrouted_apps(self):
+        self.assertEqual(self.router.db_for_read(User), None)
+        self.assertEqual(self.router.db_for_write(User), None)
+
+
+    def test_write_pins_user(self):
+        """
+        Writing an address pins its user to the primary, both in this thread
+        and for later requests.
+
+        """
+        address = models.EmailAddress(user=self.user, email=self.email)
+        routers.set_current_user(self.user.pk)
+
+        self.router.db_for_write(models.EmailAddress, instance=address)
+
+        self.assertEqual(self.router.db_for_read(models.EmailAddress), "default")
+        routers.set_current_user(None)
+        self.assertEqual(self.router.db_for_read(models.EmailAddress), "replica")
+        routers.set_current_user(self.user.pk)
+        self.assertEqual(self.router.db_for_read(models.EmailAddress), "default")
+
+
+    def test_pin_expires(self):
+        _old_pin_seconds = app_settings.EMAIL_CONFIRMATION_PIN_SECONDS
+        app_settings.EMAIL_CONFIRMATION_PIN_SECONDS = -1
+        routers.pin_user(self.user.pk)
+        app_settings.EMAIL_CONFIRMATION_PIN_SECONDS = _old_pin_seconds
+
+        routers.set_current_user(self.user.pk)
+
+        self.assertEqual(self.router.db_for_read(models.EmailAddress), "replica")
+
+
+    def test_allow_syncdb(self):
+        self.assertEqual(self.router.allow_syncdb("replica", models.EmailAddress), False)
+        self.assertEqual(self.router.allow_syncdb("default", models.EmailAddress), None)
+
+
+    def test_explicit_using(self):
+        """
+        The manager APIs take an explicit database alias.
+
+        """
+        address = models.EmailAddress.objects.add_email(self.user, self.email, using="default")
+        confirmation = models.EmailConfirmation.objects.get(email_address=address)
+
+        result = models.EmailConfirmation.objects.confirm_email(confirmation.confirmation_key, using="default")
+
+        self.assertEqual(result, address)
+        self.assertEqual(models.EmailAddress.objects.get_primary(self.user, using="default"), address)
+        self.assertEqual(models.EmailAddress.objects.get_users_for(self.email, using="default"), [self.user])
+
+
+    def test_set_as_primary_routes_user(self):
+        """
+        ``set_as_primary`` writes its addresses to the given database but
+        leaves saving the user to the routers.
+
+        """
+        written = []
+        class RecordingRouter(object):
+            def db_for_write(self, model, **hints):
+                written.append(model)
+        address = models.EmailAddress.objects.create(user=self.user, email=self.email)
+        old_routers = router.routers
+        router.routers = [RecordingRouter()]
+        try:
+            address.set_as_primary(using="default")
+        finally:
+            router.routers = old_routers
+
+        self.assertTrue(User in written)
+        self.assertEqual(User.objects.get(pk=self.user.pk).email, self.email)
+
+
+
+class ReplicaPinningTests(TransactionTestCase):
+    """
+    Runs ``ReplicaRouter`` against the "replica" test database, a second
+    connection that does not see the primary's uncommitted writes.
+
+    """
+    def setUp(self):
+        self.user = User.objects.create(username="daphne")
+        self.address = models.EmailAddress.objects.add_email(self.user, "daphne@example.com")
+        self.confirmation = models.EmailConfirmation.objects.get(email_address=self.address)
+        self._old_read_databases = app_settings.EMAIL_CONFIRMATION_READ_DATABASES
+        app_settings.EMAIL_CONFIRMATION_READ_DATABASES = ("replica",)
+        self._old_routers = router.routers
+        router.routers = [routers.ReplicaRouter()]
+        cache.delete(routers._pin_key(self.user.pk))
+        self.middleware = ReplicaPinningMiddleware()
+
+
+    def tearDown(self):
+        router.routers = self._old_routers
+        app_settings.EMAIL_CONFIRMATION_READ_DATABASES = self._old_read_databases
+        routers.set_current_user(None)
+        cache.delete(routers._pin_key(self.user.pk))
+
+
+    def _request(self, user, view):
+        request = HttpRequest()
+        request.user = user
+        self.middleware.process_request(request)
+        try:
+            return view()
+        finally:
+            self.middleware.process_response(request, HttpResponse())
+
+
+    def test_confirm_then_read_from_primary(self):
+        """
+        After a user confirms an address their next request reads from the
+        primary, even while the replica lags behind; anonymous requests still
+        read from the replica.
+
+        """
+        key = self.confirmation.confirmation_key
+        def confirm_and_read():
+            self._request(self.user, lambda: models.EmailConfirmation.objects.confirm_email(key))
+            # the confirmation is not committed yet, so the replica lags
+            self.assertEqual(models.EmailAddress.objects.get_primary(self.user, using="replica"), None)
+            return self._request(self.user, lambda: models.EmailAddress.objects.get_primary(self.user))
+        primary = transaction.commit_on_success(using="default")(confirm_and_read)()
+
+        self.assertEqual(primary, self.address)
+        self.assertEqual(self._request(AnonymousUser(), routers.is_pinned), False)
+        self.assertEqual(self._request(AnonymousUser(),
+            lambda: router.db_for_read(models.EmailAddress)), "replica")
+
+
+
+class ConnectionPoolTests(EmailConfirmationTestCase):
+
+    def setUp(self):
+        super(ConnectionPoolTests, self).setUp()
+        self.sink = SMTPSink()
+        self.sink.start()
+
+
+    def tearDown(self):
+        self.sink.stop()
+        super(ConnectionPoolTests, self).tearDown()
+
+
+    def _pool(self, **kwargs):
+        return delivery.ConnectionPool(
+            backend="django.core.mail.backends.smtp.EmailBackend",
+            host=self.sink.host, port=self.sink.port, **kwargs)
+
+
+    def _message(self, n=0):
+        return mail.EmailMessage("subject", "body", "from@example.com",
+                                 ["to%s@example.com" % n])
+
+
+    def test_reuses_connection(self):
+        pool = self._pool()
+        for n in range(3):
+            pool.send_messages([self._message(n)])
+        pool.close()
+
+        self.assertEqual(len(self.sink.messages), 3)
+        self.assertEqual(self.sink.connections, 1)
+
+
+    def test_max_messages(self):
+        pool = self._pool(max_messages=2)
+        for n in range(3):
+            pool.send_messages([self._message(n)])
+        pool.close()
+
+        self.assertEqual(len(self.sink.messages), 3)
+        self.assertEqual(self.sink.connections, 2)
+
+
+    def test_idle_timeout(self):
+        pool = self._pool(idle_timeout=60)
+        pool.send_messages([self._message()])
+        pool._idle[0].last_used -= 61
+        pool.send_messages([self._message()])
+        pool.close()
+
+        self.assertEqual(self.sink.connections, 2)
+
+
+    def test_unhealthy_connection_replaced(self):
+        pool = self._pool()
+        pool.send_messages([self._message()])
+        pool._idle[0].connection.connection.sock.close()
+        pool.send_messages([self._message()])
+        pool.close()
+
+        self.assertEqual(len(self.sink.messages), 2)
+        self.assertEqual(self.sink.connections, 2)
+
+
+    def test_threads(self):
+        """
+        Concurrent senders share the pool without exceeding its size.
+
+        """
+        pool = self._pool(size=2)
+        def send(n):
+            for i in range(5):
+                pool.send_messages([self._message(n * 10 + i)])
+        threads = [threading.Thread(target=send, args=(n,)) for n in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        pool.close()
+
+        self.assertEqual(len(self.sink.messages), 20)
+        self.assertTrue(self.sink.connections <= 2)
+
+
+    def test_send_confirmation_uses_pool(self):
+        pool = self._pool()
+        _old_pool = delivery._pool
+        delivery._pool = pool
+        try:
+            models.EmailAddress.objects.add_email(self.user, self.email)
+            models.EmailAddress.objects.add_email(self.user, "other@example.com")
+        finally:
+            delivery._pool = _old_pool
+        pool.close()
+
+        self.assertEqual([m[1] for m in self.sink.messages],
+                         [[self.email], ["other@example.com"]])
+        self.assertEqual(self.sink.connections, 1)
+
+
+
+class DeferredSignalTests(EmailConfirmationTestCase):
+
+    def setUp(self):
+        super(DeferredSignalTests, self).setUp()
+        self._old_defer = app_settings.EMAIL_CONFIRMATION_DEFER_SIGNALS
+        app_settings.EMAIL_CONFIRMATION_DEFER_SIGNALS = True
+        self.confirmed = []
+        self.batches = []
+        signals.email_confirmed.connect(self._confirmed)
+        signals.email_confirmed_batch.connect(self._batch)
+
+
+    def tearDown(self):
+        app_settings.EMAIL_CONFIRMATION_DEFER_SIGNALS = self._old_defer
+        signals.email_confirmed.disconnect(self._confirmed)
+        signals.email_confirmed_batch.disconnect(self._batch)
+        super(DeferredSignalTests, self).tearDown()
+
+
+    def _confirmed(self, sender, email_address, **kwargs):
+        self.confirmed.append(email_address)
+
+
+    def _batch(self, sender, email_addresses, **kwargs):
+        self.batches.append(email_addresses)
+
+
+    def _confirm(self, email):
+        address = models.EmailAddress.objects.add_email(self.user, email)
+        confirmation = models.EmailConfirmation.objects.get(email_address=address)
+        models.EmailConfirmation.objects.confirm_email(confirmation.confirmation_key)
+        return address
+
+
+    def test_outside_block(self):
+        """
+        Outside a deferred block signals go out immediately, each in a batch
+        of its own as well.
+
+        """
+        address = self._confirm(self.email)
+
+        self.assertEqual(self.confirmed, [address])
+        self.assertEqual(self.batches, [[address]])
+
+
+    def test_deferred_until_block_returns(self):
+        seen = []
+        def confirm_both():
+            first = self._confirm(self.email)
+            second = self._confirm("other@example.com")
+            seen.extend(self.confirmed)
+            return first, second
+        first, second = deferred.deferred(confirm_both)()
+
+        self.assertEqual(seen, [])
+        self.assertEqual(self.confirmed, [first, second])
+        self.assertEqual(self.batches, [[first, second]])
+
+
+    def test_dropped_on_exception(self):
+        def confirm_and_fail():
+            self._confirm(self.email)
+            raise ValueError
+        self.assertRaises(ValueError, deferred.deferred(confirm_and_fail))
+
+        self.assertEqual(self.confirmed, [])
+        self.assertEqual(self.batches, [])
+        self.assertFalse(deferred.is_deferring())
+
+
+    def test_not_deferred_unless_enabled(self):
+        app_settings.EMAIL_CONFIRMATION_DEFER_SIGNALS = False
+        seen = []
+        def confirm():
+            self._confirm(self.email)
+            seen.extend(self.confirmed)
+        deferred.deferred(confirm)()
+
+        self.assertEqual(len(seen), 1)
+
+
+    def test_batch_size(self):
+        _old_batch_size = app_settings.EMAIL_CONFIRMATION_SIGNAL_BATCH_SIZE
+        app_settings.EMAIL_CONFIRMATION_SIGNAL_BATCH_SIZE = 2
+        try:
+            def confirm_three():
+                for n in range(3):
+                    self._confirm("%s@example.com" % n)
+            deferred.deferred(confirm_three)()
+        finally:
+            app_settings.EMAIL_CONFIRMATION_SIGNAL_BATCH_SIZE = _old_batch_size
+
+        self.assertEqual([len(batch) for batch in self.batches], [2, 1])
+
+
+    def test_call_after_commit(self):
+        called = []
+        def work():
+            deferred.call_after_commit(called.append, 1)
+            self.assertEqual(called, [])
+        deferred.deferred(work)()
+
+        self.assertEqual(called, [1])
+
+
+    def test_middleware(self):
+        middleware = DeferredMiddleware()
+        request = HttpRequest()
+
+        middleware.process_request(request)
+        address = self._confirm(self.email)
+        self.assertEqual(self.confirmed, [])
+        middleware.process_response(request, HttpResponse())
+
+        self.assertEqual(self.confirmed, [address])
+
+
+    def test_middleware_exception(self):
+        middleware = DeferredMiddleware()
+        request = HttpRequest()
+
+        middleware.process_request(request)
+        self._confirm(self.email)
+        middleware.process_exception(request, ValueError())
+        middleware.process_response(request, HttpResponse())
+
+        self.assertEqual(self.confirmed, [])
+
+
+    def test_middleware_response_skipped(self):
+        """
+        A request whose ``process_response`` never ran (a later response
+        middleware raised) does not swallow the next request's work.
+
+        """
+        middleware = DeferredMiddleware()
+        called = []
+
+        middleware.process_request(HttpRequest())
+        deferred.call_after_commit(called.append, "failed")
+
+        request = HttpRequest()
+        middleware.process_request(request)
+        deferred.call_after_commit(called.append, "next")
+        middleware.process_response(request, HttpResponse())
+
+        self.assertEqual(called, ["next"])
+        self.assertFalse(deferred.is_deferring())
+
+
+
+class BlockingPool(object):
+    """
+    Stands in for a ``ConnectionPool``; the first send waits for ``release``.
+
+    """
+    def __init__(self):
+        self.sent = []
+        self.started = threading.Event()
+        self.release = threading.Event()
+
+    def send_messages(self, messages):
+        if not self.started.isSet():
+            self.started.set()
+            self.release.wait(5)
+        self.sent.append((threading.currentThread(), messages))
+        return len(messages)
+
+
+
+class ThreadedDeliveryTests(EmailConfirmationTestCase):
+
+    def setUp(self):
+        super(ThreadedDeliveryTests, self).setUp()
+        self._old_delivery = app_settings.EMAIL_CONFIRMATION_DELIVERY
+        app_settings.EMAIL_CONFIRMATION_DELIVERY = "thread"
+
+
+    def tearDown(self):
+        app_settings.EMAIL_CONFIRMATION_DELIVERY = self._old_delivery
+        super(ThreadedDeliveryTests, self).tearDown()
+
+
+    def test_send_confirmation(self):
+        models.EmailAddress.objects.add_email(self.user, self.email)
+        delivery.flush()
+
+        self.assertEqual(mail.outbox[-1].to, [self.email])
+
+
+    def test_waits_for_commit(self):
+        def add():
+            models.EmailAddress.objects.add_email(self.user, self.email)
+            self.assertEqual(delivery.get_threaded().queue.qsize(), 0)
+            self.assertEqual(mail.outbox, [])
+        deferred.deferred(add)()
+        delivery.flush()
+
+        self.assertEqual(mail.outbox[-1].to, [self.email])
+
+
+    def test_dropped_on_rollback(self):
+        def add_and_fail():
+            models.EmailAddress.objects.add_email(self.user, self.email)
+            raise ValueError
+        self.assertRaises(ValueError, deferred.deferred(add_and_fail))
+        delivery.flush()
+
+        self.assertEqual(mail.outbox, [])
+
+
+    def test_full_queue_sends_synchronously(self):
+        pool = BlockingPool()
+        threaded = delivery.ThreadedDelivery(workers=1, queue_size=1, pool=pool)
+
+        threaded.submit(["first"])
+        pool.started.wait(5)
+        threaded.submit(["queued"])
+        threaded.submit(["overflow"])
+        pool.release.set()
+        threaded.shutdown()
+
+        self.assertEqual([messages for thread, messages in pool.sent],
+                         [["overflow"], ["first"], ["queued"]])
+        self.assertEqual(pool.sent[0][0], threading.currentThread())
+
+
+    def test_shutdown_drains_queue(self):
+        pool = BlockingPool()
+        threaded = delivery.ThreadedDelivery(workers=2, queue_size=10, pool=pool)
+        pool.release.set()
+
+        for n in range(5):
+            threaded.submit([n])
+        threaded.shutdown()
+
+        self.assertEqual(sorted([messages for thread, messages in pool.sent]),
+                         [[0], [1], [2], [3], [4]])
+        self.assertEqual(threaded._threads, [])
+
+
+
+class ConfirmationCountTests(EmailConfirmationTestCase):
+
+    def _counts(self, day=None, site=None):
+        if day is None:
+            day = datetime.date.today()
+        if site is None:
+            site = Site.objects.get_current()
+        try:
+            count = models.ConfirmationCount.objects.get(site=site, day=day)
+        except models.ConfirmationCount.DoesNotExist:
+            return (0, 0, 0)
+        return (count.sent, count.confirmed, count.expired)
+
+
+    def test_send_and_confirm(self):
+        """
+        ``send_confirmation`` counts a send and ``confirm_email`` counts the
+        first use of each key only.
+
+        """
+        address = models.EmailAddress.objects.add_email(self.user, self.email)
+        models.EmailAddress.objects.add_email(self.user, "other@example.com")
+        confirmation = models.EmailConfirmation.objects.get(email_address=address)
+
+        models.EmailConfirmation.objects.confirm_email(confirmation.confirmation_key)
+        models.EmailConfirmation.objects.confirm_email(confirmation.confirmation_key)
+
+        self.assertEqual(self._counts(), (2, 1, 0))
+        self.assertNotEqual(models.EmailConfirmation.objects.get(pk=confirmation.pk).confirmed_at, None)
+
+
+    def test_delete_expired_confirmations(self):
+        """
+        The purge counts expired keys that were never used, on the day they
+        expired.
+
+        """
+        unused = models.EmailAddress.objects.add_email(self.user, self.email)
+        used = models.EmailAddress.objects.add_email(self.user, "other@example.com")
+        models.EmailConfirmation.objects.confirm_email(
+            models.EmailConfirmation.objects.get(email_address=used).confirmation_key)
+        expired_at = datetime.datetime.now() - datetime.timedelta(days=1)
+        models.EmailConfirmation.objects.update(expires_at=expired_at)
+
+        models.EmailConfirmation.objects.delete_expired_confirmations()
+
+        self.assertEqual(self._counts(expired_at.date())[2], 1)
+
+
+    def test_delete_expired_confirmations_routed(self):
+        """
+        With replicas configured the purge still counts on the database it
+        deletes from.
+
+        """
+        models.EmailAddress.objects.add_email(self.user, self.email)
+        expired_at = datetime.datetime.now() - datetime.timedelta(days=1)
+        models.EmailConfirmation.objects.update(expires_at=expired_at)
+        old_routers = router.routers
+        old_read_databases = app_settings.EMAIL_CONFIRMATION_READ_DATABASES
+        router.routers = [routers.ReplicaRouter()]
+        app_settings.EMAIL_CONFIRMATION_READ_DATABASES = ("replica",)
+        try:
+            models.EmailConfirmation.objects.delete_expired_confirmations()
+        finally:
+            router.routers = old_routers
+            app_settings.EMAIL_CONFIRMATION_READ_DATABASES = old_read_databases
+
+        self.assertEqual(models.EmailConfirmation.objects.count(), 0)
+        self.assertEqual(self._counts(expired_at.date())[2], 1)
+
+
+    def test_two_sites(self):
+        """
+        Each confirmation counts towards the site that sent it, whichever
+        site confirms, purges or rebuilds.
+
+        """
+        site = Site.objects.get_current()
+        other = Site.objects.create(domain="other.example.com", name="other")
+        models.EmailAddress.objects.add_email(self.user, self.email)
+        old_site_id = settings.SITE_ID
+        settings.SITE_ID = other.pk
+        Site.objects.clear_cache()
+        try:
+            confirmed = models.EmailAddress.objects.add_email(self.user, "confirmed@example.com")
+            models.EmailAddress.objects.add_email(self.user, "expired@example.com")
+        finally:
+            settings.SITE_ID = old_site_id
+            Site.objects.clear_cache()
+        models.EmailConfirmation.objects.confirm_email(
+            models.EmailConfirmation.objects.get(email_address=confirmed).confirmation_key)
+        self.assertEqual(self._counts(), (1, 0, 0))
+        self.assertEqual(self._counts(site=other), (2, 1, 0))
+
+        models.ConfirmationCount.objects.update(sent=0, confirmed=0)
+        models.ConfirmationCount.objects.rebuild(site=site)
+        self.assertEqual(self._counts(), (1, 0, 0))
+        self.assertEqual(self._counts(site=other), (0, 0, 0))
+        models.ConfirmationCount.objects.rebuild()
+        self.assertEqual(self._counts(site=other), (2, 1, 0))
+
+        expired_at = datetime.datetime.now() - datetime.timedelta(days=1)
+        models.EmailConfirmation.objects.filter(
+            email_address__email="expired@example.com").update(expires_at=expired_at)
+        models.EmailConfirmation.objects.delete_expired_confirmations()
+        self.assertEqual(self._counts(expired_at.date()), (0, 0, 0))
+        self.assertEqual(self._counts(expired_at.date(), site=other), (0, 0, 1))
+
+
+    def test_increment_creates_row_once(self):
+        models.ConfirmationCount.objects.increment("sent")
+        models.ConfirmationCount.objects.increment("sent", 2)
+
+        self.assertEqual(models.ConfirmationCount.objects.count(), 1)
+        self.assertEqual(self._counts(), (3, 0, 0))
+
+
+    def test_rebuild(self):
+        address = models.EmailAddress.objects.add_email(self.user, self.email)
+        models.EmailAddress.objects.add_email(self.user, "other@example.com")
+        models.EmailConfirmation.objects.confirm_email(
+            models.EmailConfirmation.objects.get(email_address=address).confirmation_key)
+        models.ConfirmationCount.objects.increment("expired", 4)
+        models.ConfirmationCount.objects.update(sent=0, confirmed=0)
+
+        call_command("rebuild_confirmation_counts", verbosity=0)
+
+        self.assertEqual(self._counts(), (2, 1, 4))
+
+
+
+class ResendConfirmationsTests(EmailConfirmationTestCase):
+
+    def setUp(self):
+        super(ResendConfirmationsTests, self).setUp()
+        expired = models.EmailAddress.objects.add_email(self.user, "expired@example.com")
+        models.EmailConfirmation.objects.filter(email_address=expired).update(
+            expires_at=datetime.datetime.now() - datetime.timedelta(days=1))
+        models.EmailAddress.objects.add_email(self.user, "live@example.com")
+        models.EmailAddress.objects.create(user=self.user, email="verified@example.com", verified=True)
+        models.EmailAddress.objects.create(user=self.user, email="none@example.com")
+        mail.outbox = []
+        fd, self.checkpoint = tempfile.mkstemp()
+        os.close(fd)
+        os.remove(self.checkpoint)
+
+
+    def tearDown(self):
+        if os.path.exists(self.checkpoint):
+            os.remove(self.checkpoint)
+        super(ResendConfirmationsTests, self).tearDown()
+
+
+    def _resend(self):
+        call_command("resend_confirmations", rate=1000, batch_size=1,
+                     checkpoint=self.checkpoint, verbosity=0)
+        return [m.to[0] for m in mail.outbox]
+
+
+    def test_resend(self):
+        """
+        Unverified addresses without a live key get a new confirmation, and
+        the checkpoint is removed once the run completes.
+
+        """
+        self.assertEqual(self._resend(), ["expired@example.com", "none@example.com"])
+        self.assertFalse(os.path.exists(self.checkpoint))
+        self.assertEqual(self._resend(), ["expired@example.com", "none@example.com"])
+
+
+    def test_resume_from_checkpoint(self):
+        expired = models.EmailAddress.objects.get(email="expired@example.com")
+        f = open(self.checkpoint, "w")
+        f.write("%d\n" % expired.pk)
+        f.close()
+
+        self.assertEqual(self._resend(), ["none@example.com"])
+
+
+    def test_rate_in_thread_mode(self):
+        """
+        With threaded delivery the command still sends each message itself,
+        at ``--rate``, rather than queueing whole batches.
+
+        """
+        sends = []
+        class RecordingPool(object):
+            def send_messages(self, messages):
+                sends.append((threading.currentThread(), time.time()))
+                return len(messages)
+        old_delivery = app_settings.EMAIL_CONFIRMATION_DELIVERY
+        old_pool = delivery._pool
+        app_settings.EMAIL_CONFIRMATION_DELIVERY = "thread"
+        delivery._pool = RecordingPool()
+        try:
+            call_command("resend_confirmations", rate=10, batch_size=2,
+                         checkpoint=self.checkpoint, verbosity=0)
+        finally:
+            app_settings.EMAIL_CONFIRMATION_DELIVERY = old_delivery
+            delivery._pool = old_pool
+
+        self.assertEqual(len(sends), 2)
+        self.assertEqual([thread for thread, at in sends],
+                         [threading.currentThread()] * 2)
+        self.assertTrue(sends[1][1] - sends[0][1] >= 0.09)
+
+
+
+class RecordingCursor(object):
+    """
+    Wraps a cursor, noting every statement run through it.
+
+    """
+    def __init__(self, cursor, statements):
+        self.cursor = cursor
+        self.statements = statements
+
+    def execute(self, sql, params=()):
+        self.statements.append((sql, params))
+        return self.cursor.execute(sql, params)
+
+    def __getattr__(self, attr):
+        return getattr(self.cursor, attr)
+
+
+
+class QueryPlanTests(TransactionTestCase):
+    """
+    Every query the managers run against the app's tables must be answered
+    from an index. SQLite commits before running ``EXPLAIN``, hence no
+    ``TestCase``.
+
+    """
+    def setUp(self):
+        self.user = User.objects.create(username="daphne")
+        self.email = "daphne@example.com"
+        for i in range(20):
+            user = User.objects.create(username="user%d" % i)
+            for j in range(3):
+                models.EmailAddress.objects.create(user=user,
+                    email="%d@%d.example.com" % (j, i), verified=j < 2, primary=j == 0)
+        models.EmailAddress.objects.add_email(self.user, self.email)
+        self.statements = []
+        self._old_DEBUG = settings.DEBUG
+        settings.DEBUG = True
+        connection.make_debug_cursor = lambda cursor: RecordingCursor(cursor, self.statements)
+
+
+    def tearDown(self):
+        settings.DEBUG = self._old_DEBUG
+        del connection.make_debug_cursor
+
+
+    def _plan(self, sql, params):
+        cursor = connection.cursor()
+        engine = connection.settings_dict["ENGINE"].split(".")[-1]
+        if engine == "sqlite3":
+            cursor.execute("EXPLAIN QUERY PLAN " + sql, params)
+            return [row[-1] for row in cursor.fetchall()]
+        if engine.startswith("postgresql"):
+            # the test tables are tiny; make the planner show what it would
+            # do on a real one
+            cursor.execute("SET enable_seqscan = off")
+            cursor.execute("EXPLAIN " + sql, params)
+            plan = [row[0] for row in cursor.fetchall()]
+            cursor.execute("RESET enable_seqscan")
+            return plan
+        # other backends' plans are not checked
+        return []
+
+
+    def assertIndexed(self, func, *args):
+        del self.statements[:]
+        func(*args)
+        statements = [(sql, params) for sql, params in self.statements
+            if sql.split(None, 1)[0].upper() in ("SELECT", "UPDATE", "DELETE")
+            and "emailconfirmation_" in sql]
+        self.assertTrue(statements)
+        settings.DEBUG = False
+        try:
+            for sql, params in statements:
+                for step in self._plan(sql, params):
+                    # SQLite says "SCAN <table>" for a full table or index
+                    # scan, PostgreSQL "Seq Scan on <table>"
+                    full_scan = step.startswith("SCAN ") or "Seq Scan on" in step
+                    self.assertFalse(full_scan and "emailconfirmation_" in step,
+                        "%s\nfalls back to a full scan: %s" % (sql, step))
+                    self.assertFalse("TEMP B-TREE FOR ORDER BY" in step,
+                        "%s\nsorts instead of reading an index in order" % sql)
+        finally:
+            settings.DEBUG = True
+
+
+    def test_address_lookups(self):
+        manager = models.EmailAddress.objects
+        self.assertIndexed(manager.get_primary, self.user)
+        self.assertIndexed(manager.get_primary_record, self.user.pk)
+        self.assertIndexed(manager.get_users_for, "0@1.example.com")
+        self.assertIndexed(manager.get_user_ids_for, "0@1.example.com")
+        self.assertIndexed(manager.get_verified_records, self.user.pk)
+        self.assertIndexed(manager.is_email_available, "0@1.example.com")
+        self.assertIndexed(lambda user: list(verified_emails(user)), self.user)
+
+
+    def test_confirmation_lookups(self):
+        manager = models.EmailConfirmation.objects
+        confirmation = manager.get(email_address__email=self.email)
+        self.assertIndexed(manager.confirm_email, confirmation.confirmation_key)
+        self.assertIndexed(manager.delete_expired_confirmations)
+
+
+
 class ViewTests(EmailConfirmationTestCase):
     def test_confirm(self):
         """
@@ -1,5 +1,7 @@
 #!/usr/bin/env python
+import os
 import sys
+import tempfile
 
 from os.path import dirname, abspath
 
@@ -7,7 +9,25 @@ from django.conf import settings
 
 if not settings.configured:
     settings.configure(
-        DATABASE_ENGINE='sqlite3',
+        DATABASES={
+            'default': {
+                'ENGINE': 'django.db.backends.sqlite3',
+                # on disk rather than in memory so tests can share it between
+                # threads
+                'TEST_NAME': os.path.join(tempfile.gettempdir(),
+                    'emailconfirmation-tests-%d.db' % os.getpid()),
+                'OPTIONS': {'timeout': 30},
+            },
+            # a second connection to the same database, for the router tests;
+            # it does not see uncommitted writes, much like a lagging replica
+            'replica': {
+                'ENGINE': 'django.db.backends.sqlite3',
+                'OPTIONS': {'timeout': 30},
+                'TEST_MIRROR': 'default',
+                # Django 1.2 only works this out for databases it creates
+                'SUPPORTS_TRANSACTIONS': True,
+            },
+        },
         SITE_ID=1,
         ROOT_URLCONF='emailconfirmation.urls',
         INSTALLED_APPS=[